@@ -0,0 +1,275 @@
+''' Benchmarks for hydration, serialization and the query paths.
+
+Runs against the in-memory backend, so no server is needed:
+
+    python benchmarks/run.py [--output results.json] [--compare old.json]
+
+Each benchmark reports operations per second, the best of several runs,
+and the number of garbage collected objects each operation leaves alive.
+`--output` saves the results as JSON, and `--compare` prints the change
+from a saved run '''
+import argparse
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from txmongoobject import model  # noqa: E402
+from txmongoobject.memory import MemoryBackend  # noqa: E402
+
+
+def _articleFields():
+    ''' The properties of an article: plain, key-mapped, nested and
+    reference fields '''
+    fields = {
+        'title': model.stringProperty(),
+        'slug': model.stringProperty(maxLength=64),
+        'body': model.stringProperty(),
+        'views': model.intProperty(unsigned=True),
+        'score': model.floatProperty(),
+        'published': model.boolProperty(default=False),
+        'pdate': model.dateProperty(),
+        'tags': model.listProperty(),
+        'meta': model.dictProperty(),
+        'author': model.referenceProperty(Author),
+        'reviewers': model.listProperty(wrapper=model.referenceProperty(Author)),
+        '_rating': model.intProperty(key='rating'),
+        '_lang': model.stringProperty(key='lang'),
+        '_region': model.stringProperty(key='region'),
+    }
+    for i in range(8):
+        fields['extra%d' % i] = model.intProperty()
+    return fields
+
+
+class Author(model.MongoObj):
+    collection = 'bench_author'
+    name = model.stringProperty()
+    email = model.stringProperty()
+
+
+Article = model.metaMongoObj('Article', (model.MongoObj, ), dict(
+    _articleFields(), collection='bench_article', __module__=__name__))
+CompactArticle = model.metaMongoObj('CompactArticle', (model.MongoObj, ), dict(
+    _articleFields(), collection='bench_compact_article', compact=True,
+    __module__=__name__))
+
+
+class NewsArticle(Article):
+    collection = Article.collection
+    source = model.stringProperty()
+
+
+class OpinionArticle(Article):
+    collection = Article.collection
+    stance = model.stringProperty()
+
+
+def _sync(d):
+    ''' The result of a Deferred that has already fired '''
+    out = []
+    d.addBoth(out.append)
+    if not out:
+        raise RuntimeError('Deferred has not fired')
+    if isinstance(out[0], model.Failure):
+        out[0].raiseException()
+    return out[0]
+
+
+def _document(i, authors):
+    return {
+        'title': u'Article %d' % i,
+        'slug': 'article-%d' % i,
+        'body': u'Lorem ipsum dolor sit amet ' * 20,
+        'views': i * 7,
+        'score': i / 3.0,
+        'published': bool(i % 2),
+        'pdate': datetime(2015, 1, 1 + i % 28, 12, 30),
+        'tags': ['tag%d' % j for j in range(i % 5)],
+        'meta': {'words': 120 + i, 'source': {'name': 'wire', 'id': i}},
+        'author': authors[i % len(authors)],
+        'reviewers': [authors[(i + j) % len(authors)] for j in range(3)],
+        'rating': i % 5,
+        'lang': 'en',
+        'region': 'us',
+        'extra0': i, 'extra1': i, 'extra2': i, 'extra3': i,
+        'extra4': i, 'extra5': i, 'extra6': i, 'extra7': i,
+    }
+
+
+def setup(count=200):
+    ''' Fill an in-memory backend with authors and a mix of article
+    subclasses. Returns the ids of the articles '''
+    model.MongoObj.setBackend(MemoryBackend())
+    authors = []
+    for i in range(20):
+        a = Author()
+        a.name = u'Author %d' % i
+        a.email = 'author%d@example.com' % i
+        _sync(a.save())
+        authors.append(a._id)
+    ids = []
+    for i in range(count):
+        cls = (Article, NewsArticle, OpinionArticle)[i % 3]
+        obj = cls()
+        obj.setValues(_document(i, authors))
+        _sync(obj.save())
+        ids.append(obj._id)
+    return authors, ids
+
+
+def _hydrate(cls, doc):
+    def run():
+        obj = cls()
+        obj.setValues(doc)
+        return obj
+    return run
+
+
+def _readAll(obj, attrs):
+    def run():
+        for i in attrs:
+            getattr(obj, i)
+    return run
+
+
+def _writeAll(obj, values):
+    def run():
+        for k, v in values:
+            setattr(obj, k, v)
+    return run
+
+
+def _applyItems(docs):
+    def run():
+        res = model.MongoSet({}, Article)
+        res._docs = docs
+        res._result = [None] * len(docs)
+        return list(res)
+    return run
+
+
+def benchmarks(authors, ids):
+    ''' (name, function, operations per call) for every benchmark '''
+    doc = _sync(Article.getCollection().find_one({'_id': ids[0]}))
+    article = Article()
+    article.setValues(doc)
+    compact = CompactArticle()
+    compact.setValues(doc)
+    attrs = [i.attr for i in Article._schema().fields]
+    values = [(i, getattr(article, i)) for i in attrs if i not in ('_id', '_unmarshal_class')]
+    docs = _sync(Article.getCollection().find({}, limit=100))
+    encoded = article.as_json()
+    loaded = _sync(Article.find({'_id': {'$in': ids[:20]}}))
+    objs = list(loaded)
+
+    def loadRefs():
+        for i in objs:
+            i.author = i.author._id if isinstance(i.author, Author) else i.author
+            i.reviewers = [getattr(j, '_id', j) for j in i.reviewers]
+        _sync(model.loadAllRefs(objs))
+
+    return [
+        ('setValues', _hydrate(Article, doc), 1),
+        ('setValues_compact', _hydrate(CompactArticle, doc), 1),
+        ('getValues', article.getValues, 1),
+        ('getValues_compact', compact.getValues, 1),
+        ('descriptor_get', _readAll(article, attrs), len(attrs)),
+        ('descriptor_get_compact', _readAll(compact, attrs), len(attrs)),
+        ('descriptor_set', _writeAll(article, values), len(values)),
+        ('applyItem_polymorphic', _applyItems(docs), len(docs)),
+        ('as_json', article.as_json, 1),
+        ('from_json', lambda: Article.from_json(encoded), 1),
+        ('loadRefs', loadRefs, len(objs)),
+        ('findOne', lambda: _sync(Article.findOne(ids[0])), 1),
+        ('find', lambda: list(_sync(Article.find({'published': True}, limit=50))), 50),
+    ]
+
+
+def measure(func, perCall, duration=0.2, repeat=3):
+    ''' The best operations per second over `repeat` runs of at least
+    `duration` seconds, and the garbage collected objects left alive per
+    operation by what it returns. Objects freed during the call are not
+    counted '''
+    func()
+    calls = 1
+    while True:
+        started = time.time()
+        for _ in xrange(calls):
+            func()
+        elapsed = time.time() - started
+        if elapsed >= duration / 10:
+            break
+        calls *= 2
+    calls = max(1, int(calls * duration / max(elapsed, 1e-9)))
+    best = 0.0
+    for _ in range(repeat):
+        gc.collect()
+        started = time.time()
+        for _ in xrange(calls):
+            func()
+        elapsed = time.time() - started
+        best = max(best, calls * perCall / elapsed)
+
+    gc.collect()
+    before = len(gc.get_objects())
+    kept = [func() for _ in xrange(100)]
+    gc.collect()
+    retained = (len(gc.get_objects()) - before - 1) / (100.0 * perCall)
+    del kept
+    return best, max(retained, 0.0)
+
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the txmongoobject benchmarks')
+    parser.add_argument('--output', help='save the results to this JSON file')
+    parser.add_argument('--compare', help='compare with results saved by --output')
+    parser.add_argument('--duration', type=float, default=0.2,
+                        help='seconds per timed run')
+    parser.add_argument('names', nargs='*', help='only run these benchmarks')
+    args = parser.parse_args(argv)
+
+    authors, ids = setup()
+    previous = {}
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)['results']
+
+    results = OrderedDict()
+    print '%-24s %14s %12s %10s' % ('benchmark', 'ops/sec', 'retained/op',
+                                    'change')
+    for name, func, perCall in benchmarks(authors, ids):
+        if args.names and name not in args.names:
+            continue
+        rate, retained = measure(func, perCall, args.duration)
+        results[name] = {'ops_per_sec': rate,
+                         'retained_objects_per_op': retained}
+        change = ''
+        if name in previous:
+            change = '%+.1f%%' % ((rate / previous[name]['ops_per_sec'] - 1) * 100)
+        print '%-24s %14.1f %12.2f %10s' % (name, rate, retained, change)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'commit': _commit(), 'python': platform.python_version(),
+                       'time': datetime.utcnow().isoformat(), 'results': results},
+                      f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -23,4 +23,7 @@ setup(name='txmongoobject',
           'pytz',
           "iso8601"
       ],
+      extras_require={
+          'columns': ['numpy'],
+      },
       zip_safe=False)
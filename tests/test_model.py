@@ -1,14 +1,25 @@
-from txmongoobject import model
+from txmongoobject import memory, model, stats
 from twisted.trial import unittest
-from twisted.internet import defer
+from twisted.internet import defer, reactor, task
 from datetime import datetime
+import io
+import json
+import os
 try:
     from txmongo._pymongo.objectid import ObjectId
 except ImportError:
     from bson.objectid import ObjectId
 import pytz
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from pymongo.write_concern import WriteConcern
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 model.MongoObj.dbname = 'test_database'
+# Run against a server with TEST_MONGO_HOST=127.0.0.1, otherwise in memory
+MONGO_HOST = os.environ.get('TEST_MONGO_HOST')
 
 
 class Fragment(model.MongoObj):
@@ -61,14 +72,70 @@ class SecondChildObject(ChildCountObject):
     pass
 
 
+class CompactObject(model.MongoObj):
+    compact = True
+    testString = model.stringProperty()
+    testInt = model.intProperty(key='number')
+    testRef = model.referenceProperty(Fragment)
+
+
+class CompactChildObject(CompactObject):
+    collection = CompactObject.collection
+    testFloat = model.floatProperty()
+
+
+class Address(model.MongoSubObj):
+    city = model.stringProperty()
+    lines = model.listProperty()
+
+
+class Person(model.MongoObj):
+    name = model.stringProperty()
+    tags = model.listProperty()
+    meta = model.dictProperty(allowNone=False)
+    address = model.objectProperty(Address)
+
+
+class Place(model.MongoObj):
+    name = model.stringProperty(unique=True)
+    code = model.stringProperty(sparse=True)
+    location = model.geoPointProperty(index=True)
+    _kind = model.stringProperty(key='kind')
+    indexes = [model.MongoIndex(['_kind', ('cdate', -1)]),
+               model.MongoIndex('cdate', expireAfterSeconds=3600,
+                                name='expiry')]
+
+
+class SlowCollection(object):
+    ''' Wraps a collection so every result arrives a reactor turn late, and
+    records the methods called on it '''
+
+    def __init__(self, collection, calls):
+        self._collection = collection
+        self._calls = calls
+
+    def __getattr__(self, name):
+        method = getattr(self._collection, name)
+
+        def call(*args, **kwargs):
+            self._calls.append(name)
+            d = defer.Deferred()
+            method(*args, **kwargs).addBoth(
+                lambda r: reactor.callLater(0, d.callback, r))
+            return d
+        return call
+
+
 class TestCollection(unittest.TestCase):
 
     timeout = 15
 
     @defer.inlineCallbacks
     def setUp(self):
-        # model.MongoObj.mongo = yield model.txmongo.MongoConnection('127.0.0.1', 27017)
-        yield model.MongoObj.connect('127.0.0.1', 27017)
+        if MONGO_HOST:
+            yield model.MongoObj.connect(MONGO_HOST, 27017)
+        else:
+            model.MongoObj.setBackend(memory.MemoryBackend())
 
     @defer.inlineCallbacks
     def tearDown(self):
@@ -427,3 +494,1086 @@ class TestCollection(unittest.TestCase):
 
         b = CollectionObject()
         self.assertEqual(b.testDict, {})
+
+    def test_schema(self):
+        ''' Ensure the schema follows subclasses and late properties '''
+        keys = SecondChildObject().getKeys()
+        self.assertIn('number', keys)
+        self.assertIn('_unmarshal_class', keys)
+        schema = KeyTestCollection._schema()
+        self.assertEqual(schema.keyToAttr['testInt'], '_testInt')
+
+        CountCollectionObject.lateValue = model.intProperty(default=3)
+        try:
+            self.assertEqual(SecondChildObject().getValues()['lateValue'], 3)
+        finally:
+            del CountCollectionObject.lateValue
+        self.assertNotIn('lateValue', SecondChildObject().getValues())
+
+    @defer.inlineCallbacks
+    def test_load_refs_batch(self):
+        ''' Ensure find(loadRefs=True) resolves references across results '''
+        yield CollectionObject.getCollection().remove(
+            {"testString": "test_refs"})
+        frags = []
+        for i in range(3):
+            frag = Fragment()
+            frag.testValue = 'frag %d' % i
+            yield frag.save()
+            frags.append(frag)
+        for i in range(4):
+            obj = CollectionObject()
+            obj.testString = "test_refs"
+            obj.testRef = frags[i % 3]
+            obj.testRefList = [frags[0], frags[2]]
+            yield obj.save()
+        missing = CollectionObject()
+        missing.testString = "test_refs"
+        missing.testRef = ObjectId()
+        yield missing.save()
+
+        res = yield CollectionObject.find({"testString": "test_refs"},
+                                          loadRefs=True, sort=[["testRef", 1]])
+        self.assertEqual(len(res), 5)
+        loaded = [i for i in res if i._id != missing._id]
+        for obj in loaded:
+            self.assertIsInstance(obj.testRef, Fragment)
+            self.assertEqual([i.testValue for i in obj.testRefList],
+                             ['frag 0', 'frag 2'])
+        missing = [i for i in res if i._id == missing._id][0]
+        self.assertIdentical(missing.testRef, None)
+        yield CollectionObject.getCollection().remove(
+            {"testString": "test_refs"})
+
+    @defer.inlineCallbacks
+    def test_session(self):
+        ''' Ensure a session returns one instance per document '''
+        frag = Fragment()
+        yield frag.save()
+        obj = CollectionObject()
+        obj.testString = "test_session"
+        obj.testRef = frag
+        yield obj.save()
+
+        session = model.MongoSession()
+        first = yield session.findOne(CollectionObject, obj._id, loadRefs=True)
+        second = yield CollectionObject.findOne(obj._id, session=session)
+        self.assertIdentical(first, second)
+        res = yield session.find(CollectionObject, {"_id": obj._id},
+                                 loadRefs=True)
+        self.assertIdentical(res[0], first)
+        self.assertIdentical(first.testRef, session.get(Fragment, frag._id))
+
+        first.testString = "test_session_flushed"
+        new = CollectionObject()
+        session.add(new)
+        self.assertEqual(len(session.dirty()), 2)
+        yield session.flush()
+        self.assertEqual(session.dirty(), [])
+        self.assertIdentical(session.get(CollectionObject, new._id), new)
+        reloaded = yield CollectionObject.findOne(obj._id)
+        self.assertEqual(reloaded.testString, "test_session_flushed")
+
+        yield new.remove()
+        self.assertIdentical(session.get(CollectionObject, new._id), None)
+
+    @defer.inlineCallbacks
+    def test_iter_find(self):
+        ''' Ensure iter_find streams every match once, batch by batch '''
+        yield CollectionObject.getCollection().remove(
+            {"testString": "test_stream"})
+        for i in range(25):
+            p = CollectionObject()
+            p.testInt = i
+            p.testString = "test_stream"
+            yield p.save()
+
+        stream = CollectionObject.iter_find({"testString": "test_stream"},
+                                            batch_size=10)
+        sizes = []
+        seen = set()
+        while True:
+            batch = yield stream.next()
+            if not batch:
+                break
+            sizes.append(len(batch))
+            seen.update(i.testInt for i in batch)
+        self.assertEqual(sizes, [10, 10, 5])
+        self.assertEqual(seen, set(range(25)))
+        self.assertEqual(stream.fetched, 25)
+
+        processed = []
+
+        def consume(obj):
+            processed.append(obj)
+            return len(processed) < 12
+
+        count = yield CollectionObject.iter_find({"testString": "test_stream"},
+                                                 batch_size=5).each(consume)
+        self.assertEqual(count, 12)
+
+        stream = CollectionObject.iter_find({"testString": "test_stream"},
+                                            batch_size=3, skip=2, limit=7)
+        ids = []
+        while True:
+            batch = yield stream.next()
+            if not batch:
+                break
+            ids.extend(i.testInt for i in batch)
+        self.assertEqual(ids, range(2, 9))
+        self.assertRaises(ValueError, CollectionObject.iter_find, {},
+                          sort=[('testInt', 1)])
+        self.assertRaises(ValueError, CollectionObject.iter_find, {},
+                          use_cursor=True)
+        yield CollectionObject.getCollection().remove(
+            {"testString": "test_stream"})
+
+    @defer.inlineCallbacks
+    def test_save_many(self):
+        ''' Ensure save_many inserts new objects and updates dirty ones '''
+        yield CollectionObject.getCollection().remove(
+            {"testString": "test_save_many"})
+        existing = CollectionObject()
+        existing.testString = "test_save_many"
+        existing.testInt = 1
+        yield existing.save()
+        existing.testInt = 2
+
+        objs = [existing]
+        for i in range(5):
+            p = CollectionObject()
+            p.testString = "test_save_many"
+            p.testInt = 10 + i
+            objs.append(p)
+
+        errors = yield CollectionObject.save_many(objs, batch_size=2)
+        self.assertEqual(errors, {})
+        for obj in objs:
+            self.assertIsInstance(obj._id, ObjectId)
+            self.assertTrue(obj.loaded)
+            self.assertEqual(len(obj._prop_dirty), 0)
+        self.assertEqual(objs[1].testExtra, 'teststring')
+        self.assertIsInstance(objs[1].cdate, datetime)
+
+        count = yield CollectionObject.count({"testString": "test_save_many"})
+        self.assertEqual(count, 6)
+        reloaded = yield CollectionObject.findOne(existing._id)
+        self.assertEqual(reloaded.testInt, 2)
+        yield CollectionObject.getCollection().remove(
+            {"testString": "test_save_many"})
+
+        yield Place.ensure_indexes()
+        places = []
+        for name in ('first', 'second'):
+            p = Place()
+            p.name = name
+            yield p.save()
+            p.code = name
+            places.append(p)
+        duplicate = Place()
+        duplicate.name = 'first'
+        fresh = Place()
+        fresh.name = 'third'
+        objs = [places[0], duplicate, fresh, places[1]]
+        errors = yield Place.save_many(objs, ordered=True)
+        self.assertEqual(sorted(errors), [1, 2, 3])
+        self.assertEqual(errors[1]['code'], 11000)
+        self.assertTrue(errors[2]['skipped'] and errors[3]['skipped'])
+        reloaded = yield Place.findOne(places[0]._id)
+        self.assertEqual(reloaded.code, 'first')
+        self.assertIdentical(fresh._id, None)
+        self.assertTrue(places[1]._hasChanges())
+
+    @defer.inlineCallbacks
+    def test_fields(self):
+        ''' Ensure partial loads only read and write the fields they loaded '''
+        obj = CollectionObject()
+        obj.testString = "test_fields"
+        obj.testInt = 5
+        obj.testDict = {"a": 1}
+        yield obj.save()
+
+        res = yield CollectionObject.find({"_id": obj._id}, fields=['testInt'])
+        partial = res[0]
+        self.assertEqual(partial.testInt, 5)
+        self.assertRaises(model.notLoadedError, getattr, partial, 'testString')
+        self.assertNotIn('testDict', partial.getValues())
+
+        partial.testInt = 6
+        yield partial.save()
+        reloaded = yield CollectionObject.findOne(obj._id)
+        self.assertEqual(reloaded.testInt, 6)
+        self.assertEqual(reloaded.testString, "test_fields")
+        self.assertEqual(reloaded.testDict, {"a": 1})
+
+        partial = yield CollectionObject.findOne(obj._id, fields=['testInt'])
+        yield partial.loadFields('testString')
+        self.assertEqual(partial.testString, "test_fields")
+        self.assertRaises(model.notLoadedError, getattr, partial, 'testDict')
+        yield partial.loadFields()
+        self.assertEqual(partial.testDict, {"a": 1})
+        self.assertEqual(len(partial._prop_dirty), 0)
+        yield obj.remove()
+
+    @defer.inlineCallbacks
+    def test_lazy_results(self):
+        ''' Ensure find results are only hydrated when accessed '''
+        yield CollectionObject.getCollection().remove(
+            {"testString": "test_lazy"})
+        for i in range(5):
+            p = CollectionObject()
+            p.testInt = i
+            p.testString = "test_lazy"
+            yield p.save()
+
+        res = yield CollectionObject.find({"testString": "test_lazy"},
+                                          sort=[["testInt", 1]])
+        self.assertEqual(len(res), 5)
+        self.assertEqual(res._result, [None] * 5)
+        self.assertEqual(res[1].testInt, 1)
+        self.assertIdentical(res[1], res[1])
+        self.assertEqual(len([i for i in res._result if i is not None]), 1)
+        self.assertEqual([i.testInt for i in res], range(5))
+
+        raw = yield CollectionObject.find({"testString": "test_lazy"},
+                                          raw=True)
+        self.assertIsInstance(raw[0], dict)
+        self.assertEqual(len(list(raw)), 5)
+        yield CollectionObject.getCollection().remove(
+            {"testString": "test_lazy"})
+
+    @defer.inlineCallbacks
+    def test_compact(self):
+        ''' Ensure compact objects behave like regular ones '''
+        obj = CompactObject()
+        obj.testString = "compact"
+        obj.testInt = 5
+        yield obj.save()
+        self.assertTrue(obj.loaded)
+        self.assertIn('number', obj._prop_data)
+
+        obj.testInt = 6
+        self.assertIn('number', obj._prop_dirty)
+        self.assertNotIn('testString', obj._prop_dirty)
+        yield obj.save()
+        self.assertEqual(len(obj._prop_dirty), 0)
+
+        child = CompactChildObject()
+        child.testFloat = 1.5
+        yield child.save()
+
+        newobj = yield CompactObject.findOne(obj._id)
+        self.assertEqual(newobj.testInt, 6)
+        self.assertEqual(newobj.testString, "compact")
+        res = yield CompactObject.find({"_id": child._id})
+        self.assertIsInstance(res[0], CompactChildObject)
+        self.assertEqual(res[0].testFloat, 1.5)
+
+        yield obj.remove()
+        yield child.remove()
+
+        self.assertRaises(TypeError, model.metaMongoObj, 'LooseObject',
+                          (CompactObject, ), {'compact': False})
+
+    def test_registry(self):
+        ''' Ensure subclasses are found by name and duplicates are reported '''
+        self.assertIdentical(
+            CountCollectionObject._find_class('SecondChildObject'),
+            SecondChildObject)
+        self.assertIdentical(CountCollectionObject._find_class('NoSuchClass'),
+                             CountCollectionObject)
+
+        key = (CountCollectionObject.collection, 'SecondChildObject')
+        try:
+            model.metaMongoObj('SecondChildObject', (ChildCountObject, ),
+                               {'__module__': 'duplicate_module'})
+            warnings = self.flushWarnings()
+            self.assertEqual(len(warnings), 1)
+            self.assertIdentical(warnings[0]['category'], RuntimeWarning)
+        finally:
+            model.metaMongoObj.registry[key] = SecondChildObject
+
+    @defer.inlineCallbacks
+    def test_to_columns(self):
+        ''' Ensure results can be exported as typed NumPy columns '''
+        if numpy is None:
+            raise unittest.SkipTest('NumPy is not installed')
+        yield CollectionObject.getCollection().remove(
+            {"testString": "test_columns"})
+        for i in range(4):
+            p = CollectionObject()
+            p.testString = "test_columns"
+            p.testInt = None if i == 2 else i
+            p.testFloat = i / 2.0
+            p.testBool = bool(i % 2)
+            p.testDate = datetime(2015, 1, i + 1)
+            yield p.save()
+
+        res = yield CollectionObject.find({"testString": "test_columns"},
+                                          sort=[["_id", 1]])
+        cols = res.to_columns(['_id', 'testInt', 'testFloat', 'testBool',
+                               'testDate'])
+        self.assertEqual(res._result, [None] * 4)
+        self.assertEqual(cols['testInt'].dtype, numpy.int64)
+        self.assertEqual(list(cols['testInt'].mask),
+                         [False, False, True, False])
+        self.assertEqual(cols['testInt'].sum(), 4)
+        self.assertEqual(cols['testFloat'].dtype, numpy.float64)
+        self.assertEqual(cols['testBool'].sum(), 2)
+        self.assertEqual(cols['testDate'][0],
+                         numpy.datetime64('2015-01-01', 'ms'))
+        self.assertEqual(cols['_id'].dtype, numpy.dtype('S12'))
+
+        stream = CollectionObject.iter_find({"testString": "test_columns"},
+                                            batch_size=3)
+        first = yield stream.next_columns(['testFloat'])
+        second = yield stream.next_columns(['testFloat'])
+        self.assertEqual((len(first['testFloat']), len(second['testFloat'])),
+                         (3, 1))
+        yield CollectionObject.getCollection().remove(
+            {"testString": "test_columns"})
+
+    @defer.inlineCallbacks
+    def test_json(self):
+        ''' Ensure the JSON codec round trips and matches MongoEncoder '''
+        frag = Fragment()
+        yield frag.save()
+        obj = CollectionObject()
+        obj.testString = u'caf\xe9'
+        obj.testInt = 5
+        obj.testDate = datetime(2015, 3, 4, 5, 6, 7, 890000)
+        obj.testRef = frag
+        obj.testRefList = [frag]
+        obj.testNoneDict = {"ref": frag._id, "when": [datetime(2015, 1, 1)]}
+        yield obj.save()
+
+        data = obj.as_json()
+        self.assertEqual(data, json.dumps(obj.getValues(),
+                                          cls=model.MongoEncoder))
+        newobj = CollectionObject.from_json(data)
+        self.assertEqual(newobj._id, obj._id)
+        self.assertEqual(newobj.testString, u'caf\xe9')
+        self.assertEqual(newobj.testDate,
+                         obj.testDate.replace(tzinfo=pytz.utc))
+        self.assertEqual(newobj.testRef, frag._id)
+        self.assertEqual(newobj.testRefList, [frag._id])
+        self.assertEqual(newobj.testNoneDict["ref"], frag._id)
+        self.assertEqual(newobj.testInt, 5)
+
+        obj.display_timezone = pytz.timezone('US/Eastern')
+        data = obj.as_json()
+        self.assertEqual(data, json.dumps(obj.getValues(),
+                                          cls=model.MongoEncoder))
+        self.assertEqual(CollectionObject.from_json(data).testDate,
+                         obj.testDate)
+
+    @defer.inlineCallbacks
+    def test_export(self):
+        ''' Ensure query results stream out as NDJSON and CSV '''
+        search = {"testString": "test_export"}
+        yield CollectionObject.getCollection().remove(search)
+        objs = []
+        for i in range(5):
+            p = CollectionObject()
+            p.testInt = i
+            p.testString = "test_export"
+            yield p.save()
+            objs.append(p)
+
+        out = io.BytesIO()
+        progress = []
+        count = yield CollectionObject.export(
+            search, out, batch_size=2,
+            progress=lambda e: progress.append(e.documents))
+        self.assertEqual(count, 5)
+        self.assertEqual(progress, [2, 4, 5])
+        lines = out.getvalue().splitlines()
+        res = yield CollectionObject.find(search, sort=[["_id", 1]])
+        self.assertEqual(lines, [i.as_json() for i in res])
+
+        out = io.BytesIO()
+        yield CollectionObject.export(search, out, format='csv',
+                                      fields=['_id', 'testInt'])
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], '_id,testInt')
+        self.assertEqual(lines[1:],
+                         ['%s,%d' % (i._id, i.testInt) for i in objs])
+
+        out = io.BytesIO()
+        yield CollectionObject.export(search, out, format='csv',
+                                      fields=['testInt'], batch_size=2,
+                                      skip=1, limit=3)
+        self.assertEqual(out.getvalue().splitlines(),
+                         ['testInt', '1', '2', '3'])
+        self.assertRaises(TypeError, CollectionObject.export, {}, io.BytesIO(),
+                          sort=[('testInt', 1)])
+        yield CollectionObject.getCollection().remove(search)
+
+    @defer.inlineCallbacks
+    def test_cache(self):
+        ''' Ensure findOne and load are served from the class cache and writes
+        invalidate it '''
+        now = [1000.0]
+        cache = model.MongoCache(size=2, ttl=60, clock=lambda: now[0])
+        CollectionObject.cache = cache
+        try:
+            p = CollectionObject()
+            p.testString = "test_cache"
+            p.testDict = {'a': 1}
+            yield p.save()
+
+            first = yield CollectionObject.findOne(p._id)
+            first.testDict['a'] = 2
+            second = yield CollectionObject.findOne(p._id)
+            self.assertEqual(second.testDict, {'a': 1})
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+            # Writes from elsewhere are not seen until the entry expires
+            yield CollectionObject.getCollection().update(
+                {'_id': p._id}, {'$set': {'testInt': 5}}, safe=True)
+            third = yield CollectionObject().load(p._id)
+            self.assertEqual(third.testInt, None)
+            now[0] += 61
+            third = yield CollectionObject().load(p._id)
+            self.assertEqual(third.testInt, 5)
+
+            p.testInt = 6
+            yield p.save()
+            fourth = yield CollectionObject.findOne(p._id)
+            self.assertEqual(fourth.testInt, 6)
+            self.assertEqual((cache.hits, cache.misses), (2, 3))
+
+            yield p.remove()
+            yield self.assertFailure(CollectionObject.findOne(fourth._id),
+                                     KeyError)
+        finally:
+            CollectionObject.cache = None
+
+    @defer.inlineCallbacks
+    def test_coalesce(self):
+        ''' Ensure concurrent identical reads share one query '''
+        yield CountCollectionObject.getCollection().remove({"number": 1400})
+        p = CountCollectionObject()
+        p.number = 1400
+        yield p.save()
+
+        calls = []
+        collection = CountCollectionObject.getCollection()
+        CountCollectionObject.getCollection = classmethod(
+            lambda cls: SlowCollection(collection, calls))
+        CountCollectionObject.coalesce = True
+        try:
+            session = model.MongoSession()
+            res = yield defer.gatherResults([
+                CountCollectionObject.findOne(p._id),
+                CountCollectionObject.findOne(p._id),
+                CountCollectionObject.findOne(p._id, session=session),
+                CountCollectionObject().load(p._id)])
+            self.assertEqual(calls, ['find_one'])
+            self.assertEqual([i._id for i in res], [p._id] * 4)
+            self.assertEqual(len(set(id(i) for i in res)), 4)
+            self.assertIdentical(session.get(CountCollectionObject, p._id),
+                                 res[2])
+
+            del calls[:]
+            res = yield defer.gatherResults([
+                CountCollectionObject.find({"number": 1400, "_id": p._id}),
+                CountCollectionObject.find({"_id": p._id, "number": 1400}),
+                CountCollectionObject.find({"number": 1400}, limit=1)])
+            self.assertEqual(calls, ['find', 'find'])
+            self.assertEqual([len(i) for i in res], [1, 1, 1])
+            self.assertNotIdentical(res[0][0], res[1][0])
+
+            # A read after a write does not join a query from before it
+            del calls[:]
+            first = CountCollectionObject.findOne(p._id)
+            p.number = 1401
+            yield p.save()
+            second = yield CountCollectionObject.findOne(p._id)
+            yield first
+            self.assertEqual(second.number, 1401)
+            self.assertEqual(calls, ['find_one', 'update', 'find_one'])
+        finally:
+            del CountCollectionObject.getCollection
+            CountCollectionObject.coalesce = False
+        yield p.remove()
+
+    @defer.inlineCallbacks
+    def test_query_cache(self):
+        ''' Ensure find results are served from the query cache until a write
+        through the class '''
+        yield CountCollectionObject.getCollection().remove({"number": 1500})
+        p = CountCollectionObject()
+        p.number = 1500
+        yield p.save()
+
+        cache = model.MongoCache(size=10, ttl=60)
+        CountCollectionObject.query_cache = cache
+        try:
+            res = yield CountCollectionObject.find({"number": 1500,
+                                                    "_id": p._id})
+            res[0].number = 1
+            self.assertEqual(len(cache), 1)
+            res = yield CountCollectionObject.find({"_id": p._id,
+                                                    "number": 1500})
+            self.assertEqual(res[0].number, 1500)
+            yield CountCollectionObject.find({"number": 1500}, limit=1)
+            self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+            q = CountCollectionObject()
+            q.number = 1500
+            yield q.save()
+            self.assertEqual(len(cache), 0)
+            res = yield CountCollectionObject.find({"number": 1500})
+            self.assertEqual(len(res), 2)
+            yield q.remove()
+            res = yield CountCollectionObject.find({"number": 1500})
+            self.assertEqual(len(res), 1)
+        finally:
+            CountCollectionObject.query_cache = None
+        yield p.remove()
+
+    @defer.inlineCallbacks
+    def test_observers(self):
+        ''' Ensure operations are reported to observers and aggregated '''
+        events = []
+        latency = stats.LatencyStats()
+        model.addObserver(events.append)
+        model.addObserver(latency)
+        try:
+            p = CountCollectionObject()
+            p.number = 1600
+            yield p.save()
+            yield CountCollectionObject.findOne(p._id)
+            res = yield CountCollectionObject.find({"number": 1600,
+                                                    "_id": p._id})
+            yield CountCollectionObject.count({"number": 1600})
+            yield self.assertFailure(CountCollectionObject.findOne(ObjectId()),
+                                     KeyError)
+        finally:
+            model.removeObserver(events.append)
+            model.removeObserver(latency)
+        yield p.remove()
+
+        finished = [i for i in events if i['event'] == 'finish']
+        self.assertEqual([i['operation'] for i in finished],
+                         ['save', 'findOne', 'find', 'count', 'findOne'])
+        self.assertEqual(len(events), 10)
+        find = finished[2]
+        self.assertEqual(find['query'], {'number': 1, '_id': 1})
+        self.assertEqual(find['documents'], 1)
+        self.assertEqual(find['bytes'], len(model.BSON.encode(res._docs[0])))
+        self.assertAlmostEqual(find['network'] + find['python'],
+                               find['duration'])
+
+        dump = latency.dump()['CountCollectionObject']
+        self.assertEqual(dump['findOne']['count'], 2)
+        self.assertEqual(dump['findOne']['documents'], 1)
+        self.assertEqual(dump['count']['count'], 1)
+        self.assertTrue(dump['find']['p50'] <= dump['find']['max'])
+
+    def test_histogram(self):
+        ''' Ensure histogram percentiles keep their significant digits '''
+        hist = stats.Histogram(digits=2)
+        for i in range(1, 100001):
+            hist.record(i)
+        self.assertEqual((hist.count, hist.min, hist.max), (100000, 1, 100000))
+        for percent, value in ((50, 50000), (99, 99000), (100, 100000)):
+            self.assertTrue(abs(hist.percentile(percent) - value) <=
+                            value / 100.0)
+        self.assertEqual(stats.Histogram().percentile(50), None)
+
+    @defer.inlineCallbacks
+    def test_memory_backend(self):
+        ''' Ensure the in-memory collection queries and updates like a
+        server '''
+        collection = memory.MemoryBackend().getCollection('test_database',
+                                                          'memory')
+        docid = yield collection.insert({'a': 1, 'tags': ['x', 'y'],
+                                         'sub': {'b': 2}})
+        yield collection.insert([{'a': 2, 'tags': []}, {'a': 3}])
+        yield self.assertFailure(collection.insert({'_id': docid}),
+                                 DuplicateKeyError)
+
+        sort = model.txmongo.filter.sort(model.txmongo.filter.DESCENDING('a'))
+        res = yield collection.find({'a': {'$gte': 2}}, sort=sort)
+        self.assertEqual([i['a'] for i in res], [3, 2])
+        res = yield collection.find({'$or': [{'tags': 'y'},
+                                             {'a': {'$in': [3]}}]},
+                                    projection={'a': 1, '_id': 0})
+        self.assertEqual(res, [{'a': 1}, {'a': 3}])
+        res = yield collection.find_one({'sub.b': 2, 'tags': {'$size': 2}})
+        self.assertEqual(res['_id'], docid)
+        res['sub']['b'] = 5
+        count = yield collection.count({'sub.b': 2})
+        self.assertEqual(count, 1)
+
+        yield collection.update({'_id': docid}, {
+            '$set': {'sub.c': 3}, '$push': {'tags': 'z'}, '$inc': {'a': 10}})
+        yield collection.update({'_id': docid}, {'$pull': {'tags': 'x'}})
+        res = yield collection.find_one(docid)
+        self.assertEqual((res['a'], res['tags'], res['sub']),
+                         (11, ['y', 'z'], {'b': 2, 'c': 3}))
+        for update in ({'$push': {'tags': 'z'}, '$pull': {'tags': 'x'}},
+                       {'$set': {'sub': {}}, '$unset': {'sub.b': ''}}):
+            yield self.assertFailure(collection.update({'_id': docid}, update),
+                                     OperationFailure)
+        res = yield collection.find_one(docid)
+        self.assertEqual((res['tags'], res['sub']), (['y', 'z'],
+                                                     {'b': 2, 'c': 3}))
+        out = yield collection.update({'a': 4}, {'$setOnInsert': {'b': 1},
+                                                 '$set': {'c': 1}},
+                                      upsert=True)
+        res = yield collection.find_one(out['upserted'])
+        self.assertEqual((res['a'], res['b'], res['c']), (4, 1, 1))
+
+        res = yield collection.find_and_modify({'a': {'$lt': 5}},
+                                               {'$set': {'d': 1}},
+                                               sort={'a': -1}, new=True)
+        self.assertEqual((res['a'], res['d']), (4, 1))
+        res = yield collection.aggregate([
+            {'$match': {'a': {'$exists': True}}},
+            {'$group': {'_id': None, 'total': {'$sum': '$a'},
+                        'n': {'$sum': 1}}}])
+        self.assertEqual(res, [{'_id': None, 'total': 20, 'n': 4}])
+        out = yield collection.remove({'a': {'$ne': 11}})
+        self.assertEqual(out['n'], 3)
+        self.assertEqual(len(collection), 1)
+
+    @defer.inlineCallbacks
+    def test_nested_dirty(self):
+        ''' Ensure changes inside dicts, lists and embedded objects are saved
+        as dotted-path updates '''
+        updates = []
+        collection = Person.getCollection()
+        update = collection.update
+
+        def record(spec, document, **kwargs):
+            updates.append(document)
+            return update(spec, document, **kwargs)
+        self.patch(collection, 'update', record)
+        self.patch(Person, 'getCollection',
+                   classmethod(lambda cls: collection))
+
+        person = Person()
+        person.tags = ['a', 'b']
+        person.meta = {'size': 1, 'colors': {'red': 1}, 'items': [{'n': 1}]}
+        person.address = {'city': 'Paris', 'lines': ['1 Rue']}
+        yield person.save()
+        person = yield Person.findOne(person._id)
+
+        person.tags.append('c')
+        person.meta['colors']['blue'] = 2
+        del person.meta['size']
+        person.meta['items'][0]['n'] = 5
+        person.address.lines.append('Apt 2')
+        person.address.city = 'Lyon'
+        self.assertTrue(person._hasChanges())
+        yield person.save()
+        self.assertEqual(updates[-1], {
+            '$set': {'meta.colors.blue': 2, 'meta.items.0.n': 5,
+                     'address.city': 'Lyon'},
+            '$unset': {'meta.size': ''},
+            '$push': {'tags': {'$each': ['c']},
+                      'address.lines': {'$each': ['Apt 2']}}})
+        self.assertFalse(person._hasChanges())
+
+        person.tags.remove('a')
+        person.meta['items'].insert(0, {'n': 0})
+        person.meta['items'][1]['n'] = 6
+        yield person.save()
+        self.assertEqual(updates[-1], {
+            '$set': {'meta.items': [{'n': 0}, {'n': 6}]},
+            '$pull': {'tags': 'a'}})
+
+        person.tags.append('d')
+        person.tags.sort()
+        yield person.save()
+        self.assertEqual(updates[-1], {'$set': {'tags': ['b', 'c', 'd']}})
+        count = len(updates)
+        yield person.save()
+        self.assertEqual(len(updates), count)
+
+        doc = yield collection.find_one(person._id)
+        self.assertEqual(doc['meta'], {'colors': {'red': 1, 'blue': 2},
+                                       'items': [{'n': 0}, {'n': 6}]})
+        self.assertEqual(doc['address'], {'city': 'Lyon',
+                                          'lines': ['1 Rue', 'Apt 2']})
+        self.assertEqual(doc['tags'], ['b', 'c', 'd'])
+
+        # Containers taken out of the value no longer change the document
+        items = person.meta['items']
+        items.append({'n': 7})
+        del person.meta['items']
+        items.append(8)
+        items[0]['n'] = 9
+        colors = person.meta['colors']
+        person.meta['colors'] = {'green': 3}
+        colors['red'] = 4
+        yield person.save()
+        self.assertEqual(updates[-1], {'$set': {'meta.colors': {'green': 3}},
+                                       '$unset': {'meta.items': ''}})
+        doc = yield collection.find_one(person._id)
+        self.assertEqual(doc['meta'], {'colors': {'green': 3}})
+
+        # A list that is appended to or pulled from is rewritten whole when
+        # a list inside it changes too, as the paths would overlap
+        person.tags = [[1], 2]
+        person.meta['c'] = [[1, 2], 3]
+        yield person.save()
+        person.tags[0].append(9)
+        person.tags.append(3)
+        yield person.save()
+        self.assertEqual(updates[-1], {'$set': {'tags': [[1, 9], 2, 3]}})
+        person.tags.append([1])
+        person.tags[-1].append(2)
+        yield person.save()
+        self.assertEqual(updates[-1],
+                         {'$set': {'tags': [[1, 9], 2, 3, [1, 2]]}})
+        person.meta['c'][0].remove(1)
+        person.meta['c'].remove(3)
+        yield person.save()
+        self.assertEqual(updates[-1], {'$set': {'meta.c': [[2]]}})
+        doc = yield collection.find_one(person._id)
+        self.assertEqual(doc['tags'], [[1, 9], 2, 3, [1, 2]])
+        self.assertEqual(doc['meta'], {'colors': {'green': 3}, 'c': [[2]]})
+
+    @defer.inlineCallbacks
+    def test_ref_concurrency(self):
+        ''' Ensure reference lookups run in parallel up to the limit '''
+        fragments = []
+        for i in range(4):
+            f = Fragment()
+            f.testValue = 'concurrent %d' % i
+            yield f.save()
+            fragments.append(f)
+        obj = CollectionObject()
+        obj.testRefList = [i._id for i in reversed(fragments)]
+        obj.testRef = ObjectId()
+        yield obj.save()
+
+        active = [0, 0]
+        collection = Fragment.getCollection()
+        find = collection.find
+
+        def slowFind(*args, **kwargs):
+            active[0] += 1
+            active[1] = max(active)
+            d = defer.Deferred()
+
+            def done(result):
+                active[0] -= 1
+                d.callback(result)
+            find(*args, **kwargs).addBoth(
+                lambda r: reactor.callLater(0.01, done, r))
+            return d
+        self.patch(collection, 'find', slowFind)
+        self.patch(Fragment, 'getCollection',
+                   classmethod(lambda cls: collection))
+
+        for concurrency, peak in ((None, 1), (2, 2), (10, 5)):
+            active[1] = 0
+            obj.testRefList = [i._id for i in reversed(fragments)]
+            obj.testRef = ObjectId()
+            yield model.loadAllRefs([obj], chunkSize=1,
+                                    concurrency=concurrency)
+            self.assertEqual(active[1], peak)
+            self.assertEqual([i.testValue for i in obj.testRefList],
+                             ['concurrent %d' % i for i in (3, 2, 1, 0)])
+            self.assertIdentical(obj.testRef, None)
+
+        res = yield CollectionObject.find({'_id': obj._id}, loadRefs=True,
+                                          ref_concurrency=4)
+        self.assertEqual([i.testValue for i in res[0].testRefList],
+                         ['concurrent %d' % i for i in (3, 2, 1, 0)])
+        obj.testRefList = [ObjectId()]
+        yield self.assertFailure(obj.loadRefs(concurrency=2), KeyError)
+
+    @defer.inlineCallbacks
+    def test_write_concern(self):
+        ''' Ensure writes use the class write concern unless given one '''
+        calls = []
+        collection = CountCollectionObject.getCollection()
+        update = collection.update
+
+        def record(spec, document, **kwargs):
+            calls.append(kwargs)
+            return update(spec, document, **kwargs)
+        self.patch(collection, 'update', record)
+        self.patch(CountCollectionObject, 'getCollection',
+                   classmethod(lambda cls: collection))
+
+        obj = CountCollectionObject()
+        obj.number = 2100
+        yield obj.save()
+        obj.number = 2101
+        out = yield obj.save()
+        self.assertTrue(out)
+        self.assertEqual(calls[-1], {'safe': True})
+
+        self.patch(CountCollectionObject, 'write_concern', WriteConcern(w=0))
+        obj.number = 2102
+        out = yield obj.save()
+        self.assertIdentical(out, None)
+        self.assertEqual(calls[-1], {'safe': False, 'w': 0})
+
+        obj.number = 2103
+        yield obj.save(write_concern=WriteConcern(w='majority', wtimeout=100))
+        self.assertEqual(calls[-1], {'safe': True, 'w': 'majority',
+                                     'wtimeout': 100})
+
+        other = CountCollectionObject()
+        other.number = 2104
+        docid = yield other.insert_unique({'number': 2104})
+        self.assertEqual(calls[-1], {'safe': True, 'upsert': True})
+        self.assertEqual(other._id, docid)
+
+        res = yield CountCollectionObject.findOne(obj._id)
+        self.assertEqual(res.number, 2103)
+        yield obj.remove()
+        yield other.remove(write_concern=WriteConcern(j=True))
+
+    @defer.inlineCallbacks
+    def test_write_buffer(self):
+        ''' Ensure buffered saves are merged per document and written in
+        bulk '''
+        objs = []
+        for i in range(3):
+            obj = Person()
+            obj.name = 'buffered %d' % i
+            obj.tags = []
+            yield obj.save()
+            objs.append(obj)
+
+        writes = []
+        collection = Person.getCollection()
+        bulk_write = collection.bulk_write
+
+        def record(requests, **kwargs):
+            writes.append([(i._filter['_id'], i._doc) for i in requests])
+            return bulk_write(requests, **kwargs)
+        self.patch(collection, 'bulk_write', record)
+        self.patch(Person, 'getCollection',
+                   classmethod(lambda cls: collection))
+        buf = model.MongoWriteBuffer(size=2, interval=0.05)
+        self.addCleanup(buf.close)
+        self.patch(Person, 'write_buffer', buf)
+        finished = []
+        model.addObserver(finished.append)
+        self.addCleanup(model.removeObserver, finished.append)
+
+        first = objs[0]
+        for tag in ('a', 'b'):
+            first.tags.append(tag)
+            first.name = 'renamed %s' % tag
+            out = yield first.save()
+            self.assertIdentical(out, None)
+        first.tags.remove('a')
+        yield first.save()
+        self.assertEqual((len(buf), writes), (1, []))
+        doc = yield collection.find_one(first._id)
+        self.assertEqual(doc['tags'], [])
+
+        failed = yield buf.flush()
+        self.assertEqual(failed, 0)
+        self.assertEqual(writes, [
+            [(first._id, {'$set': {'name': 'renamed b'},
+                          '$push': {'tags': {'$each': ['a', 'b']}}})],
+            [(first._id, {'$pull': {'tags': 'a'}})]])
+        doc = yield collection.find_one(first._id)
+        self.assertEqual((doc['name'], doc['tags']), ('renamed b', ['b']))
+        flushes = [i for i in finished
+                   if i['operation'] == 'flush' and i['event'] == 'finish']
+        self.assertEqual([i['documents'] for i in flushes], [1, 1])
+
+        # Reaching the size writes at once, an interval writes the rest
+        del writes[:]
+        for obj in objs:
+            obj.name = 'sized'
+            yield obj.save()
+        self.assertEqual([len(i) for i in writes], [2])
+        self.assertEqual((len(buf), buf.peak), (1, 2))
+        yield task.deferLater(reactor, 0.1, lambda: None)
+        self.assertEqual([len(i) for i in writes], [2, 1])
+        res = yield Person.find({'name': 'sized'})
+        self.assertEqual(len(res), 3)
+
+        objs[0].name = 'removed'
+        yield objs[0].save()
+        yield objs[0].remove()
+        self.assertEqual(len(buf), 0)
+
+    @defer.inlineCallbacks
+    def test_indexes(self):
+        ''' Ensure declared indexes are synced and collection scans are
+        warned of '''
+        collection = Place.getCollection()
+        if MONGO_HOST:
+            yield collection.drop_indexes()
+        report = yield Place.ensure_indexes()
+        self.assertEqual(sorted(report['created']), sorted([
+            'name_1', 'code_1', 'location_2dsphere', 'kind_1_cdate_-1',
+            'expiry']))
+        info = yield collection.index_information()
+        self.assertTrue(info['name_1']['unique'])
+        self.assertTrue(info['code_1']['sparse'])
+        self.assertEqual(info['expiry']['expireAfterSeconds'], 3600)
+        report = yield Place.ensure_indexes()
+        self.assertEqual(report, {'created': [], 'dropped': [],
+                                  'conflicting': [], 'undeclared': []})
+
+        yield collection.drop_index('code_1')
+        sort = model.txmongo.filter.sort
+        yield collection.create_index(sort([('code', 1)]))
+        yield collection.create_index(sort([('other', 1)]))
+        report = yield Place.ensure_indexes()
+        self.assertEqual((report['conflicting'], report['undeclared']),
+                         (['code_1'], ['other_1']))
+        report = yield Place.ensure_indexes(drop=True)
+        self.assertEqual(sorted(report['dropped']), ['code_1', 'other_1'])
+        self.assertEqual(report['created'], ['code_1'])
+
+        first = Place()
+        first.name = 'unique'
+        yield first.save()
+        second = Place()
+        second.name = 'unique'
+        yield self.assertFailure(second.save(), DuplicateKeyError)
+
+        self.patch(Place, 'explain_queries', True)
+        res = yield Place.find({'name': 'unique'})
+        self.assertEqual(len(res), 1)
+
+        def scans():
+            return [i for i in self.flushWarnings()
+                    if i['category'] is model.CollectionScanWarning]
+        self.assertEqual(scans(), [])
+        yield Place.find({'other': 1})
+        count = yield Place.count({'other': {'$gt': 1}})
+        self.assertEqual(count, 0)
+        warned = scans()
+        self.assertEqual([i['category'] for i in warned],
+                         [model.CollectionScanWarning] * 2)
+        self.assertIn('scans the whole', warned[0]['message'])
+        yield first.remove()
+        report = yield model.ensure_all_indexes()
+        self.assertEqual(report[Place.collection]['created'], [])
+        if MONGO_HOST:
+            yield collection.drop_indexes()
+
+    @defer.inlineCallbacks
+    def test_page(self):
+        ''' Ensure keyset pages walk a polymorphic collection both ways '''
+        yield CountCollectionObject.getCollection().remove({})
+        expected = []
+        kinds = (CountCollectionObject, ChildCountObject, SecondChildObject)
+        for i in range(11):
+            obj = kinds[i % 3]()
+            # Repeated numbers and a missing one test the _id tiebreaker and
+            # nulls
+            obj.number = None if i == 4 else i // 2
+            yield obj.save()
+            expected.append(obj)
+        expected.sort(key=lambda i: (i.number, i._id), reverse=True)
+        classes = dict((i._id, i.__class__) for i in expected
+                       if i.__class__ is SecondChildObject)
+        expected = [i._id for i in expected]
+
+        pages = []
+        token = None
+        while True:
+            res = yield ChildCountObject.page({}, [('number', -1)], limit=4,
+                                              after=token)
+            pages.append([i._id for i in res])
+            for i in res:
+                self.assertIdentical(i.__class__,
+                                     classes.get(i._id, ChildCountObject))
+            token = res.next_page
+            if token is None:
+                break
+        self.assertEqual([len(i) for i in pages], [4, 4, 3])
+        self.assertEqual(sum(pages, []), expected)
+
+        back = []
+        token = res.previous_page
+        while token is not None:
+            res = yield ChildCountObject.page({}, [('number', -1)], limit=4,
+                                              before=token)
+            back.insert(0, [i._id for i in res])
+            token = res.previous_page
+        self.assertEqual(back, pages[:2])
+
+        search = {'number': {'$gte': 1}}
+        res = yield CountCollectionObject.page(search, ('number', 1), limit=3)
+        self.assertEqual([i.number for i in res], [1, 1, 2])
+        res = yield CountCollectionObject.page(search, ('number', 1), limit=3,
+                                               after=res.next_page)
+        self.assertEqual([i.number for i in res], [3, 3, 4])
+        yield self.assertFailure(CountCollectionObject.page(
+            {}, [('number', -1)], after=res.previous_page), ValueError)
+        yield self.assertFailure(CountCollectionObject.page(
+            {}, ('number', 1), after='not a token'), ValueError)
+
+    @defer.inlineCallbacks
+    def test_aggregate(self):
+        ''' Ensure pipelines translate keys, hydrate subclasses and stream '''
+        yield KeyTestCollection.getCollection().remove({})
+        yield CountCollectionObject.getCollection().remove({})
+        fragments = []
+        for i in range(2):
+            f = Fragment()
+            f.testValue = 'fragment %d' % i
+            yield f.save()
+            fragments.append(f)
+        for i in range(5):
+            obj = KeyTestCollection()
+            obj._testInt = i
+            obj._testString = 'ab'[i % 2]
+            obj._testRef = fragments[i % 2]
+            yield obj.save()
+
+        p = KeyTestCollection.pipeline().match({'_testInt': {'$gte': 1}})
+        p = p.group('$_testString', _testInt={'$sum': '$_testInt'})
+        p = p.sort([('_id', 1)])
+        self.assertEqual(p.stages[0], {'$match': {'testInt': {'$gte': 1}}})
+        res = yield p.aggregate()
+        self.assertEqual(res, [{'_id': 'a', 'testInt': 6},
+                               {'_id': 'b', 'testInt': 4}])
+
+        p = KeyTestCollection.pipeline().match({'_testInt': 3})
+        p = p.lookup(Fragment, '_testRef', '_id', '_testString')
+        res = yield p.project('_testString').aggregate()
+        self.assertEqual([i['testValue'] for i in res[0]['testString']],
+                         ['fragment 1'])
+
+        for i in range(7):
+            cls = (CountCollectionObject, ChildCountObject,
+                   SecondChildObject)[i % 3]
+            obj = cls()
+            obj.number = i
+            yield obj.save()
+        spec = ChildCountObject.pipeline().match({'number': {'$gte': 1}})
+        spec = spec.sort([('number', -1)])
+        res = yield spec.aggregate(hydrate=True)
+        self.assertEqual([i.number for i in res], [6, 5, 4, 3, 2, 1])
+        self.assertEqual([i.__class__ for i in res][:3],
+                         [ChildCountObject, SecondChildObject,
+                          ChildCountObject])
+
+        stream = ChildCountObject.iter_aggregate(spec, batch_size=4,
+                                                 hydrate=True)
+        batch = yield stream.next()
+        self.assertEqual([i.number for i in batch], [6, 5, 4, 3])
+        seen = []
+        count = yield stream.each(lambda obj: seen.append(obj.number))
+        self.assertEqual((count, seen, stream.fetched), (2, [2, 1], 6))
+        batch = yield stream.next()
+        self.assertEqual(batch, [])
+
+        stream = ChildCountObject.iter_aggregate(spec.stages, batch_size=4,
+                                                 allow_disk_use=True)
+        batch = yield stream.next()
+        self.assertEqual(batch[0]['number'], 6)
+        stream.close()
+        batch = yield stream.next()
+        self.assertEqual(batch, [])
@@ -0,0 +1,30 @@
+''' Where model classes get their collections from.
+
+A backend has `getCollection(dbname, name)`, returning an object with the
+txmongo collection methods the models call, and `disconnect()`, returning a
+Deferred. `MongoObj.connect` sets a `TxMongoBackend` on the class, and
+`MongoObj.setBackend` sets any other, such as
+`txmongoobject.memory.MemoryBackend` '''
+from twisted.internet import defer
+
+
+class Backend(object):
+
+    def getCollection(self, dbname, name):
+        raise NotImplementedError
+
+    def disconnect(self):
+        return defer.succeed(None)
+
+
+class TxMongoBackend(Backend):
+    ''' Collections of a txmongo connection '''
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def getCollection(self, dbname, name):
+        return getattr(getattr(self.connection, dbname), name)
+
+    def disconnect(self):
+        return self.connection.disconnect()
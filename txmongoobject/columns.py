@@ -0,0 +1,73 @@
+''' Columnar export of query results as NumPy arrays.
+
+Columns are built straight from the documents returned by the server,
+without hydrating model objects. NumPy is an optional dependency, and is
+only needed when this module is imported. '''
+import numpy
+from collections import OrderedDict
+from txmongoobject.model import (boolProperty, dateProperty, floatProperty,
+                                 intProperty, mongoidProperty,
+                                 referenceProperty)
+
+_nullId = b'\0' * 12
+
+
+def toColumns(cls, docs, fields):
+    ''' Build one array per attribute name in `fields` from the raw
+    documents `docs` of the model class `cls`. Values go through the
+    property's `set`, so defaults and coercion match hydrated objects.
+
+    intProperty gives an int64 masked array with None masked, floatProperty
+    float64 with None as nan, boolProperty bool, dateProperty
+    datetime64[ms] with None as NaT, and mongoidProperty and
+    referenceProperty S12 arrays of the raw ObjectId bytes, with None as
+    twelve zero bytes. Anything else gives an object array '''
+    byAttr = cls._schema().byAttr
+    out = OrderedDict()
+    for attr in fields:
+        field = byAttr.get(attr)
+        if field is None:
+            out[attr] = numpy.array([i.get(attr) for i in docs], dtype=object)
+            continue
+        prop = field.prop
+        values = [prop.set(i.get(field.key)) for i in docs]
+        if isinstance(prop, (mongoidProperty, referenceProperty)):
+            out[attr] = _idColumn(values)
+        elif isinstance(prop, dateProperty):
+            out[attr] = _dateColumn(values)
+        elif isinstance(prop, boolProperty):
+            out[attr] = numpy.array(values, dtype=numpy.bool_)
+        elif isinstance(prop, intProperty):
+            out[attr] = _intColumn(values)
+        elif isinstance(prop, floatProperty):
+            out[attr] = numpy.array([numpy.nan if i is None else i
+                                     for i in values], dtype=numpy.float64)
+        else:
+            out[attr] = numpy.array(values, dtype=object)
+    return out
+
+
+def _intColumn(values):
+    mask = numpy.array([i is None for i in values], dtype=numpy.bool_)
+    data = numpy.array([0 if i is None else i for i in values],
+                       dtype=numpy.int64)
+    return numpy.ma.MaskedArray(data, mask=mask)
+
+
+def _dateColumn(values):
+    # dateProperty.set has already moved aware datetimes to UTC
+    return numpy.array([None if i is None else i.replace(tzinfo=None)
+                        for i in values], dtype='datetime64[ms]')
+
+
+def _idColumn(values):
+    out = []
+    for i in values:
+        if i is None:
+            out.append(_nullId)
+        elif hasattr(i, 'binary'):
+            out.append(i.binary)
+        else:
+            # A hydrated reference
+            out.append(i._id.binary)
+    return numpy.array(out, dtype='S12')
@@ -0,0 +1,137 @@
+''' Streaming export of query results as NDJSON or CSV '''
+import csv
+import io
+import json
+from datetime import datetime
+from twisted.internet import defer
+from twisted.internet.interfaces import IConsumer, IPushProducer
+from zope.interface import implementer
+from txmongoobject.model import MongoEncoder, ObjectId
+
+
+@implementer(IPushProducer)
+class MongoExporter(object):
+    ''' Writes the objects of `cls` that match `search` to `target` one
+    batch at a time, so only one batch is held in memory.
+
+    `target` is a file-like object or a Twisted `IConsumer`. A consumer gets
+    the exporter registered as its producer, and no further batch is
+    fetched while it has paused it. NDJSON lines are the objects' `as_json`;
+    CSV columns are `fields`, or every property of the class.
+
+    `documents`, `batches` and `bytes` count what has been written so far,
+    and `progress`, if given, is called with the exporter after every
+    batch '''
+
+    formats = ('ndjson', 'csv')
+    # The options of iter_find that make sense for an export
+    options = ('limit', 'skip', 'loadRefs', 'display_timezone', 'session',
+               'ref_concurrency')
+
+    def __init__(self, cls, search, target, format='ndjson', fields=None,
+                 batch_size=100, progress=None, **kwargs):
+        if format not in self.formats:
+            raise ValueError('format must be one of %s' %
+                             ', '.join(self.formats))
+        for i in kwargs:
+            if i not in self.options:
+                raise TypeError('%s is not an export option' % i)
+        self._class = cls
+        self._search = search
+        self._target = target
+        self._format = format
+        self._fields = fields
+        self._batch_size = batch_size
+        self._progress = progress
+        self._kwargs = kwargs
+        self._consumer = IConsumer.providedBy(target)
+        self._paused = None
+        self._stopped = False
+        self.documents = 0
+        self.batches = 0
+        self.bytes = 0
+
+    @defer.inlineCallbacks
+    def start(self):
+        ''' Run the export. Fires with the number of documents written '''
+        kwargs = dict(self._kwargs)
+        if self._fields is not None:
+            kwargs['fields'] = self._fields
+        stream = self._class.iter_find(self._search,
+                                       batch_size=self._batch_size, **kwargs)
+        if self._consumer:
+            self._target.registerProducer(self, True)
+        try:
+            if self._format == 'csv':
+                self._write(self._csvRows([self._columns()]))
+            while not self._stopped:
+                if self._paused is not None:
+                    yield self._paused
+                    continue
+                batch = yield stream.next()
+                if not batch:
+                    break
+                if self._format == 'csv':
+                    columns = self._columns()
+                    data = self._csvRows([self._csvRow(i, columns)
+                                          for i in batch])
+                else:
+                    data = ''.join(i.as_json() + '\n' for i in batch)
+                self._write(data)
+                self.documents += len(batch)
+                self.batches += 1
+                if self._progress is not None:
+                    self._progress(self)
+        finally:
+            stream.close()
+            if self._consumer:
+                self._target.unregisterProducer()
+        defer.returnValue(self.documents)
+
+    def pauseProducing(self):
+        if self._paused is None:
+            self._paused = defer.Deferred()
+
+    def resumeProducing(self):
+        paused, self._paused = self._paused, None
+        if paused is not None:
+            paused.callback(None)
+
+    def stopProducing(self):
+        self._stopped = True
+        self.resumeProducing()
+
+    def _write(self, data):
+        self.bytes += len(data)
+        self._target.write(data)
+
+    def _columns(self):
+        if self._fields is not None:
+            return list(self._fields)
+        return [i.attr for i in self._class._schema().fields]
+
+    def _csvRow(self, obj, columns):
+        row = []
+        for i in columns:
+            value = getattr(obj, i, None)
+            if value is None:
+                value = ''
+            elif isinstance(value, ObjectId):
+                value = str(value)
+            elif isinstance(value, datetime):
+                value = value.isoformat()
+            elif hasattr(value, '_id'):
+                # A loaded reference
+                value = str(value._id)
+            elif isinstance(value, (dict, list)):
+                value = json.dumps(value, cls=MongoEncoder)
+            elif isinstance(value, unicode):
+                value = value.encode('utf-8')
+            row.append(value)
+        return row
+
+    @staticmethod
+    def _csvRows(rows):
+        out = io.BytesIO()
+        csv.writer(out).writerows(rows)
+        return out.getvalue()
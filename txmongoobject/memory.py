@@ -0,0 +1,1063 @@
+''' An in-memory stand-in for txmongo collections.
+
+`MemoryBackend` gives model classes collections that keep their documents
+in memory, for tests and benchmarks that should not need a server. The
+collections take the same arguments as txmongo's and return Deferreds. They
+support the parts of the query language, the update operators and the
+aggregation stages, including `$lookup` between collections of the same
+backend, that this library uses, and raise `OperationFailure` for
+anything else. Unique indexes are enforced, and `explain` plans an index
+scan whenever an index starts with a field the query uses.
+
+Documents are stored BSON encoded, so what comes back is always a fresh
+copy, decoded the way a server connection would decode it '''
+import copy
+import functools
+import operator
+import re
+from collections import OrderedDict
+from datetime import datetime
+from bson import BSON, SON, Binary, ObjectId
+from bson.regex import Regex
+from pymongo.errors import (BulkWriteError, DuplicateKeyError,
+                            InvalidOperation, OperationFailure)
+from pymongo.results import BulkWriteResult, InsertManyResult
+from twisted.internet import defer
+from txmongo.collection import Collection
+from txmongo.protocol import INSERT_CONTINUE_ON_ERROR
+from txmongoobject.backend import Backend
+
+_patternTypes = (type(re.compile('')), Regex)
+
+
+def _deferred(method):
+    ''' Return the result of `method`, or its exception, as a Deferred '''
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        return defer.maybeDeferred(method, *args, **kwargs)
+    return wrapper
+
+
+def _typeOrder(value):
+    ''' The position of the type of `value` in the BSON comparison order '''
+    if value is None:
+        return 1
+    if isinstance(value, bool):
+        return 8
+    if isinstance(value, (int, long, float)):
+        return 2
+    if isinstance(value, Binary):
+        return 6
+    if isinstance(value, basestring):
+        return 3
+    if isinstance(value, dict):
+        return 4
+    if isinstance(value, (list, tuple)):
+        return 5
+    if isinstance(value, ObjectId):
+        return 7
+    if isinstance(value, datetime):
+        return 9
+    return 10
+
+
+def _sortKey(value):
+    return (_typeOrder(value), value)
+
+
+def _eq(a, b):
+    return _typeOrder(a) == _typeOrder(b) and a == b
+
+
+def _hashKey(value):
+    ''' A hashable key for any BSON value '''
+    if isinstance(value, (ObjectId, basestring, int, long, float, datetime)):
+        return value
+    return BSON.encode({'': value})
+
+
+def _values(doc, path):
+    ''' Every value at the dotted `path` in `doc`, descending into arrays '''
+    values = [doc]
+    for part in path.split('.'):
+        found = []
+        for value in values:
+            if isinstance(value, dict):
+                if part in value:
+                    found.append(value[part])
+            elif isinstance(value, list):
+                if part.isdigit():
+                    if int(part) < len(value):
+                        found.append(value[int(part)])
+                else:
+                    found.extend(i[part] for i in value
+                                 if isinstance(i, dict) and part in i)
+        values = found
+    return values
+
+
+def _first(values):
+    return values[0] if values else None
+
+
+def _candidates(values):
+    ''' The values at a path plus the members of any arrays among them '''
+    out = list(values)
+    for i in values:
+        if isinstance(i, list):
+            out.extend(i)
+    return out
+
+
+def _isOperators(cond):
+    return isinstance(cond, dict) and bool(cond) and \
+        all(k.startswith('$') for k in cond)
+
+
+def _match(doc, spec):
+    ''' Whether `doc` matches the query `spec` '''
+    for key, cond in spec.iteritems():
+        if key == '$and':
+            if not all(_match(doc, i) for i in cond):
+                return False
+        elif key == '$or':
+            if not any(_match(doc, i) for i in cond):
+                return False
+        elif key == '$nor':
+            if any(_match(doc, i) for i in cond):
+                return False
+        elif key == '$comment':
+            continue
+        elif key.startswith('$'):
+            raise OperationFailure('unknown top level operator: %s' % key)
+        elif not _matchField(_values(doc, key), cond):
+            return False
+    return True
+
+
+def _matchField(values, cond):
+    if isinstance(cond, _patternTypes):
+        return _regex(values, _compile(cond, ''))
+    if not _isOperators(cond):
+        return _equals(values, cond)
+    for op, arg in cond.iteritems():
+        if op == '$options':
+            continue
+        if op == '$regex':
+            arg = _compile(arg, cond.get('$options', ''))
+        test = _operators.get(op)
+        if test is None:
+            raise OperationFailure('unknown operator: %s' % op)
+        if not test(values, arg):
+            return False
+    return True
+
+
+def _equals(values, cond):
+    if cond is None:
+        return not values or any(i is None for i in _candidates(values))
+    return any(_eq(i, cond) for i in _candidates(values))
+
+
+def _compare(test):
+    def compare(values, arg):
+        order = _typeOrder(arg)
+        return any(_typeOrder(i) == order and test(i, arg)
+                   for i in _candidates(values))
+    return compare
+
+
+def _compile(pattern, options):
+    if isinstance(pattern, Regex):
+        return pattern.try_compile()
+    if isinstance(pattern, _patternTypes):
+        return pattern
+    flags = 0
+    for i in options:
+        flags |= {'i': re.I, 'm': re.M, 's': re.S, 'x': re.X}.get(i, 0)
+    return re.compile(pattern, flags)
+
+
+def _regex(values, pattern):
+    return any(isinstance(i, basestring) and pattern.search(i)
+               for i in _candidates(values))
+
+
+def _in(values, arg):
+    for i in arg:
+        if isinstance(i, _patternTypes):
+            if _regex(values, _compile(i, '')):
+                return True
+        elif _equals(values, i):
+            return True
+    return False
+
+
+def _elemMatch(values, arg):
+    for value in values:
+        if not isinstance(value, list):
+            continue
+        for i in value:
+            if _isOperators(arg):
+                if _matchField([i], arg):
+                    return True
+            elif isinstance(i, dict) and _match(i, arg):
+                return True
+    return False
+
+
+_operators = {
+    '$eq': _equals,
+    '$ne': lambda values, arg: not _equals(values, arg),
+    '$gt': _compare(operator.gt),
+    '$gte': _compare(operator.ge),
+    '$lt': _compare(operator.lt),
+    '$lte': _compare(operator.le),
+    '$in': _in,
+    '$nin': lambda values, arg: not _in(values, arg),
+    '$exists': lambda values, arg: bool(values) == bool(arg),
+    '$all': lambda values, arg: all(_equals(values, i) for i in arg),
+    '$size': lambda values, arg: any(isinstance(i, list) and len(i) == arg
+                                     for i in values),
+    '$regex': _regex,
+    '$not': lambda values, arg: not _matchField(values, arg),
+    '$elemMatch': _elemMatch,
+}
+
+
+def _sorted(items, orderby, doc=lambda i: i):
+    ''' `items` sorted by the (key, direction) pairs of `orderby` '''
+    items = list(items)
+    for key, direction in reversed(list(orderby)):
+        items.sort(key=lambda i: _sortKey(_first(_values(doc(i), key))),
+                   reverse=direction < 0)
+    return items
+
+
+def _project(doc, projection):
+    ''' `doc` with only the fields `projection` asks for '''
+    if not projection:
+        return doc
+    if isinstance(projection, (list, tuple)):
+        projection = dict((i, 1) for i in projection)
+    keepId = projection.get('_id', 1)
+    fields = [k for k in projection if k != '_id']
+    if any(projection[k] for k in fields) or (not fields and keepId):
+        out = _include(doc, [k for k in fields if projection[k]] + ['_id'])
+        if not keepId:
+            out.pop('_id', None)
+        return out
+    return _exclude(doc, [k for k, v in projection.iteritems() if not v])
+
+
+def _split(paths):
+    heads = OrderedDict()
+    for path in paths:
+        head, _, rest = path.partition('.')
+        heads.setdefault(head, []).append(rest)
+    return heads
+
+
+def _include(doc, paths):
+    heads = _split(paths)
+    out = {}
+    for key, value in doc.iteritems():
+        if key not in heads:
+            continue
+        rests = heads[key]
+        if '' in rests:
+            out[key] = value
+        elif isinstance(value, dict):
+            out[key] = _include(value, rests)
+        elif isinstance(value, list):
+            out[key] = [_include(i, rests) for i in value
+                        if isinstance(i, dict)]
+    return out
+
+
+def _exclude(doc, paths):
+    heads = _split(paths)
+    out = {}
+    for key, value in doc.iteritems():
+        rests = heads.get(key)
+        if rests is None:
+            out[key] = value
+        elif '' in rests:
+            continue
+        elif isinstance(value, dict):
+            out[key] = _exclude(value, rests)
+        elif isinstance(value, list):
+            out[key] = [_exclude(i, rests) if isinstance(i, dict) else i
+                        for i in value]
+        else:
+            out[key] = value
+    return out
+
+
+def _get(container, key, default=None):
+    if isinstance(container, dict):
+        return container.get(key, default)
+    if isinstance(container, list) and key.isdigit() and \
+            int(key) < len(container):
+        return container[int(key)]
+    return default
+
+
+def _assign(container, key, value):
+    if isinstance(container, list):
+        if not key.isdigit():
+            raise OperationFailure("Cannot create field '%s' in an array" %
+                                   key)
+        index = int(key)
+        container.extend([None] * (index + 1 - len(container)))
+        container[index] = value
+    else:
+        container[key] = value
+
+
+def _parent(doc, path, create):
+    ''' The container holding the last part of the dotted `path`, and that
+    part. With `create` missing containers on the way are added '''
+    parts = path.split('.')
+    current = doc
+    for part in parts[:-1]:
+        child = _get(current, part)
+        if child is None:
+            if not create:
+                return None, parts[-1]
+            child = {}
+            _assign(current, part, child)
+        elif not isinstance(child, (dict, list)):
+            raise OperationFailure("Cannot create field '%s' in element "
+                                   "{%s: %r}" % (parts[-1], part, child))
+        current = child
+    return current, parts[-1]
+
+
+def _set(doc, path, value):
+    parent, key = _parent(doc, path, True)
+    _assign(parent, key, value)
+
+
+def _unset(doc, path, value):
+    parent, key = _parent(doc, path, False)
+    if isinstance(parent, dict):
+        parent.pop(key, None)
+    elif isinstance(parent, list) and key.isdigit() and int(key) < len(parent):
+        parent[int(key)] = None
+
+
+def _inc(doc, path, value):
+    parent, key = _parent(doc, path, True)
+    current = _get(parent, key, 0)
+    if _typeOrder(current) != 2 or _typeOrder(value) != 2:
+        raise OperationFailure('Cannot apply $inc to a value of non-numeric '
+                               'type')
+    _assign(parent, key, current + value)
+
+
+def _array(doc, path, op):
+    parent, key = _parent(doc, path, True)
+    current = _get(parent, key)
+    if current is None:
+        current = []
+        _assign(parent, key, current)
+    elif not isinstance(current, list):
+        raise OperationFailure('Cannot apply %s to a non-array value' % op)
+    return current
+
+
+def _each(value, op):
+    if isinstance(value, dict) and '$each' in value:
+        if len(value) > 1:
+            raise OperationFailure('%s modifiers other than $each are not '
+                                   'supported' % op)
+        return value['$each']
+    return [value]
+
+
+def _push(doc, path, value):
+    _array(doc, path, '$push').extend(_each(value, '$push'))
+
+
+def _addToSet(doc, path, value):
+    array = _array(doc, path, '$addToSet')
+    for i in _each(value, '$addToSet'):
+        if not any(_eq(i, j) for j in array):
+            array.append(i)
+
+
+def _pull(doc, path, cond):
+    parent, key = _parent(doc, path, False)
+    current = _get(parent, key)
+    if current is None:
+        return
+    if not isinstance(current, list):
+        raise OperationFailure('Cannot apply $pull to a non-array value')
+
+    def matches(i):
+        if _isOperators(cond):
+            return _matchField([i], cond)
+        if isinstance(cond, dict):
+            return isinstance(i, dict) and _match(i, cond)
+        return _eq(i, cond)
+    current[:] = [i for i in current if not matches(i)]
+
+
+def _pop(doc, path, value):
+    array = _array(doc, path, '$pop')
+    if array:
+        array.pop(0 if value < 0 else -1)
+
+
+_updaters = {
+    '$set': _set,
+    '$unset': _unset,
+    '$inc': _inc,
+    '$push': _push,
+    '$addToSet': _addToSet,
+    '$pull': _pull,
+    '$pop': _pop,
+}
+
+
+def _applyUpdate(doc, update, inserting=False):
+    ''' Apply `update` to `doc` in place. An update without operators
+    replaces everything but the _id '''
+    if not any(k.startswith('$') for k in update):
+        docid = doc.get('_id')
+        doc.clear()
+        doc.update(copy.deepcopy(update))
+        if docid is not None:
+            doc.setdefault('_id', docid)
+        return
+    # Like the server, refuse operators whose paths are the same or nest
+    paths = [path for fields in update.itervalues() for path in fields]
+    seen = set()
+    for path in sorted(paths, key=lambda i: i.count('.')):
+        parts = path.split('.')
+        for i in range(1, len(parts) + 1):
+            prefix = '.'.join(parts[:i])
+            if prefix in seen:
+                raise OperationFailure("Updating the path '%s' would create "
+                                       "a conflict at '%s'" % (path, prefix))
+        seen.add(path)
+    for op, fields in update.iteritems():
+        if op == '$setOnInsert':
+            if not inserting:
+                continue
+            op = '$set'
+        apply = _updaters.get(op)
+        if apply is None:
+            raise OperationFailure('Unknown modifier: %s' % op)
+        for path, value in fields.iteritems():
+            apply(doc, path, copy.deepcopy(value))
+
+
+def _upsertDoc(spec):
+    ''' The document an upsert starts from, the equality conditions of
+    `spec` '''
+    doc = {}
+    for key, cond in spec.iteritems():
+        if key == '$and':
+            for i in cond:
+                for k, v in _upsertDoc(i).iteritems():
+                    _set(doc, k, v)
+        elif key.startswith('$'):
+            continue
+        elif _isOperators(cond):
+            if '$eq' in cond:
+                _set(doc, key, cond['$eq'])
+        else:
+            _set(doc, key, cond)
+    return doc
+
+
+def _expr(doc, expr):
+    ''' Evaluate an aggregation expression against `doc` '''
+    if isinstance(expr, basestring) and expr.startswith('$'):
+        return _first(_values(doc, expr[1:]))
+    if isinstance(expr, dict):
+        if len(expr) == 1 and expr.keys()[0].startswith('$'):
+            op, arg = expr.items()[0]
+            if op == '$literal':
+                return arg
+            func = _expressions.get(op)
+            if func is None:
+                raise OperationFailure('Unrecognized expression %r' % op)
+            if isinstance(arg, list):
+                return func(*[_expr(doc, i) for i in arg])
+            return func(_expr(doc, arg))
+        return dict((k, _expr(doc, v)) for k, v in expr.iteritems())
+    if isinstance(expr, list):
+        return [_expr(doc, i) for i in expr]
+    return expr
+
+
+_expressions = {
+    '$add': lambda *args: sum(args),
+    '$subtract': operator.sub,
+    '$multiply': lambda *args: reduce(operator.mul, args, 1),
+    '$divide': operator.truediv,
+    '$concat': lambda *args: None if None in args else ''.join(args),
+    '$ifNull': lambda value, default: default if value is None else value,
+    '$size': len,
+    '$eq': _eq,
+    '$ne': lambda a, b: not _eq(a, b),
+    '$gt': lambda a, b: _sortKey(a) > _sortKey(b),
+    '$gte': lambda a, b: _sortKey(a) >= _sortKey(b),
+    '$lt': lambda a, b: _sortKey(a) < _sortKey(b),
+    '$lte': lambda a, b: _sortKey(a) <= _sortKey(b),
+    '$toLower': lambda value: (value or '').lower(),
+    '$toUpper': lambda value: (value or '').upper(),
+}
+
+
+def _numbers(values):
+    return [i for i in values if _typeOrder(i) == 2]
+
+
+def _addToSetAcc(values):
+    out = []
+    for i in values:
+        if not any(_eq(i, j) for j in out):
+            out.append(i)
+    return out
+
+
+_accumulators = {
+    '$sum': lambda values: sum(_numbers(values)),
+    '$avg': lambda values: (float(sum(_numbers(values))) /
+                            len(_numbers(values))
+                            if _numbers(values) else None),
+    '$min': lambda values: min([i for i in values if i is not None] or [None],
+                               key=_sortKey),
+    '$max': lambda values: max([i for i in values if i is not None] or [None],
+                               key=_sortKey),
+    '$first': lambda values: values[0] if values else None,
+    '$last': lambda values: values[-1] if values else None,
+    '$push': list,
+    '$addToSet': _addToSetAcc,
+}
+
+
+def _group(docs, spec):
+    groups = OrderedDict()
+    for doc in docs:
+        key = _expr(doc, spec['_id'])
+        groups.setdefault(_hashKey(key), (key, []))[1].append(doc)
+    out = []
+    for key, members in groups.itervalues():
+        result = {'_id': key}
+        for field, acc in spec.iteritems():
+            if field == '_id':
+                continue
+            (op, arg), = acc.items()
+            func = _accumulators.get(op)
+            if func is None:
+                raise OperationFailure('unknown group operator %r' % op)
+            result[field] = func([_expr(i, arg) for i in members])
+        out.append(result)
+    return out
+
+
+def _projectStage(docs, spec):
+    if not any(v for k, v in spec.iteritems() if k != '_id'):
+        return [_project(i, spec) for i in docs]
+    out = []
+    for doc in docs:
+        result = {}
+        if spec.get('_id', 1) and '_id' in doc:
+            result['_id'] = doc['_id']
+        for key, value in spec.iteritems():
+            if key == '_id' and value in (0, 1, True, False):
+                continue
+            if value is True or value == 1:
+                values = _values(doc, key)
+                if values:
+                    _set(result, key, values[0])
+            else:
+                _set(result, key, _expr(doc, value))
+        out.append(result)
+    return out
+
+
+def _unwind(docs, spec):
+    if isinstance(spec, dict):
+        path = spec['path']
+        preserve = spec.get('preserveNullAndEmptyArrays', False)
+    else:
+        path, preserve = spec, False
+    path = path[1:]
+    out = []
+    for doc in docs:
+        value = _first(_values(doc, path))
+        if not isinstance(value, list):
+            if value is not None or preserve:
+                out.append(doc)
+            continue
+        if not value and preserve:
+            out.append(doc)
+        for i in value:
+            new = copy.deepcopy(doc)
+            _set(new, path, i)
+            out.append(new)
+    return out
+
+
+_stages = {
+    '$match': lambda docs, spec: [i for i in docs if _match(i, spec)],
+    '$sort': lambda docs, spec: _sorted(docs, spec.items()),
+    '$skip': lambda docs, count: docs[count:],
+    '$limit': lambda docs, count: docs[:count],
+    '$project': _projectStage,
+    '$group': _group,
+    '$unwind': _unwind,
+    '$count': lambda docs, name: [{name: len(docs)}] if docs else [],
+}
+
+
+class _Bulk(object):
+    ''' Collects the operations of pymongo's bulk request objects '''
+
+    def __init__(self):
+        self.ops = []
+
+    def add_insert(self, document):
+        document.setdefault('_id', ObjectId())
+        self.ops.append(('insert', document))
+
+    def add_update(self, selector, update, multi=False, upsert=False,
+                   **kwargs):
+        self.ops.append(('update', (selector, update, multi, upsert)))
+
+    def add_replace(self, selector, replacement, upsert=False, **kwargs):
+        self.ops.append(('update', (selector, replacement, False, upsert)))
+
+    def add_delete(self, selector, limit, **kwargs):
+        self.ops.append(('delete', (selector, limit)))
+
+
+class MemoryCollection(object):
+    ''' A collection kept in memory '''
+
+    def __init__(self, dbname, name, backend=None):
+        self.dbname = dbname
+        self.name = name
+        # Where $lookup finds the other collections of the database
+        self.backend = backend
+        # _id: (BSON, decoded document). The decoded documents are only used
+        # for matching and never handed out
+        self._docs = OrderedDict()
+        # name: index_information entry
+        self._indexes = OrderedDict([('_id_', {
+            'v': 2, 'key': SON([('_id', 1)]), 'name': '_id_',
+            'ns': str(self)})])
+
+    def __str__(self):
+        return '%s.%s' % (self.dbname, self.name)
+
+    def __len__(self):
+        return len(self._docs)
+
+    def _copy(self, key):
+        return BSON(self._docs[key][0]).decode()
+
+    def _put(self, key, doc):
+        raw = BSON.encode(doc)
+        decoded = BSON(raw).decode()
+        for name, index in self._indexes.iteritems():
+            if index.get('unique') and name != '_id_':
+                self._checkUnique(key, decoded, index)
+        self._docs[key] = (raw, decoded)
+
+    def _checkUnique(self, key, doc, index):
+        ''' Raise DuplicateKeyError if another document has the same values
+        for the keys of the unique `index` '''
+        fields = index['key'].keys()
+        if index.get('sparse') and not any(_values(doc, i) for i in fields):
+            return
+        value = [_first(_values(doc, i)) for i in fields]
+        for other, (_, stored) in self._docs.iteritems():
+            if other == key:
+                continue
+            if index.get('sparse') and \
+                    not any(_values(stored, i) for i in fields):
+                continue
+            if all(_eq(a, _first(_values(stored, i)))
+                   for a, i in zip(value, fields)):
+                raise DuplicateKeyError(
+                    'E11000 duplicate key error collection: %s index: %s '
+                    'dup key: %r' % (self, index['name'], value), 11000)
+
+    def _select(self, spec):
+        ''' The (key, document) pairs that match `spec`, in insertion
+        order '''
+        docid = spec.get('_id')
+        if docid is not None and \
+                not isinstance(docid, (dict, list) + _patternTypes):
+            key = _hashKey(docid)
+            entry = self._docs.get(key)
+            if entry is None or not _match(entry[1], spec):
+                return []
+            return [(key, entry[1])]
+        return [(k, v[1]) for k, v in self._docs.iteritems()
+                if _match(v[1], spec)]
+
+    def _insertOne(self, doc):
+        if '_id' not in doc:
+            doc['_id'] = ObjectId()
+        key = _hashKey(doc['_id'])
+        if key in self._docs:
+            raise DuplicateKeyError(
+                'E11000 duplicate key error collection: %s index: _id_ '
+                'dup key: { : %r }' % (self, doc['_id']), 11000)
+        self._put(key, doc)
+        return doc['_id']
+
+    def _update(self, spec, update, upsert=False, multi=False):
+        matched = self._select(spec)
+        if not multi:
+            matched = matched[:1]
+        modified = 0
+        for key, stored in matched:
+            doc = self._copy(key)
+            _applyUpdate(doc, update)
+            if doc.get('_id') != stored['_id']:
+                raise OperationFailure("Performing an update on the path "
+                                       "'_id' would modify the immutable "
+                                       "field '_id'", 66)
+            if doc != stored:
+                self._put(key, doc)
+                modified += 1
+        result = {'ok': 1.0, 'err': None, 'n': len(matched),
+                  'nModified': modified, 'updatedExisting': bool(matched)}
+        if not matched and upsert:
+            doc = _upsertDoc(spec)
+            _applyUpdate(doc, update, inserting=True)
+            result['upserted'] = self._insertOne(doc)
+            result['n'] = 1
+        return result
+
+    def _remove(self, spec, single=False):
+        matched = self._select(spec)
+        if single:
+            matched = matched[:1]
+        for key, _ in matched:
+            del self._docs[key]
+        return len(matched)
+
+    def _find(self, filter=None, projection=None, skip=0, limit=0, sort=None,
+              **kwargs):
+        spec = filter or {}
+        orderby = sort.get('orderby') if sort else None
+        if '$query' in spec:
+            orderby = spec.get('$orderby', orderby)
+            spec = spec['$query']
+        matched = self._select(spec)
+        if orderby:
+            if isinstance(orderby, dict):
+                orderby = orderby.items()
+            matched = _sorted(matched, orderby, doc=operator.itemgetter(1))
+        if skip:
+            matched = matched[skip:]
+        if limit:
+            matched = matched[:abs(limit)]
+        return [_project(self._copy(key), projection) for key, _ in matched]
+
+    @staticmethod
+    def _acknowledged(safe, kwargs):
+        return safe is not False and kwargs.get('w', 1) != 0
+
+    @staticmethod
+    def _batches(docs, size):
+        ''' `docs` as a txmongo cursor: the first batch, and a Deferred
+        firing with the next (batch, Deferred), ending with ([], None) '''
+        following = defer.succeed(([], None))
+        for start in reversed(xrange(size, len(docs), size)):
+            following = defer.succeed((docs[start:start + size], following))
+        return docs[:size], following
+
+    @_deferred
+    def find(self, *args, **kwargs):
+        kwargs = Collection._find_args_compat(*args, **kwargs)
+        docs = self._find(**kwargs)
+        if kwargs.get('cursor'):
+            return self._batches(docs, kwargs.get('batch_size') or 101)
+        return docs
+
+    @_deferred
+    def find_with_cursor(self, *args, **kwargs):
+        kwargs = Collection._find_args_compat(*args, **kwargs)
+        return self._batches(self._find(**kwargs),
+                             kwargs.get('batch_size') or 101)
+
+    @_deferred
+    def find_one(self, *args, **kwargs):
+        kwargs = Collection._find_args_compat(*args, **kwargs)
+        if isinstance(kwargs['filter'], ObjectId):
+            kwargs['filter'] = {'_id': kwargs['filter']}
+        kwargs['limit'] = 1
+        return _first(self._find(**kwargs))
+
+    @_deferred
+    def count(self, filter=None, **kwargs):
+        if 'spec' in kwargs:
+            filter = kwargs['spec']
+        return len(self._find(filter, skip=kwargs.get('skip', 0),
+                              limit=kwargs.get('limit', 0)))
+
+    @_deferred
+    def insert(self, docs, safe=None, flags=0, **kwargs):
+        single = isinstance(docs, dict)
+        if single:
+            docs = [docs]
+        elif not isinstance(docs, list):
+            raise TypeError('TxMongo: insert takes a document or a list of '
+                            'documents.')
+        ids = []
+        for doc in docs:
+            if not isinstance(doc, dict):
+                raise TypeError('TxMongo: insert takes a document or a list '
+                                'of documents.')
+            doc.setdefault('_id', ObjectId())
+            ids.append(doc['_id'])
+        for doc in docs:
+            try:
+                self._insertOne(doc)
+            except DuplicateKeyError:
+                if not flags & INSERT_CONTINUE_ON_ERROR:
+                    raise
+        return ids[0] if single else ids
+
+    @_deferred
+    def insert_many(self, documents, ordered=True):
+        bulk = _Bulk()
+        for doc in documents:
+            if not isinstance(doc, dict):
+                raise TypeError('TxMongo: insert_many takes list of '
+                                'documents.')
+            bulk.add_insert(doc)
+        self._bulk(bulk.ops, ordered)
+        return InsertManyResult([i[1]['_id'] for i in bulk.ops], True)
+
+    @_deferred
+    def update(self, spec, document, upsert=False, multi=False, safe=None,
+               flags=0, **kwargs):
+        if not isinstance(spec, dict):
+            raise TypeError('TxMongo: spec must be an instance of dict.')
+        if not isinstance(document, dict):
+            raise TypeError('TxMongo: document must be an instance of dict.')
+        result = self._update(spec, document, upsert, multi)
+        return result if self._acknowledged(safe, kwargs) else None
+
+    @_deferred
+    def save(self, doc, safe=None, **kwargs):
+        if not isinstance(doc, dict):
+            raise TypeError('TxMongo: cannot save objects of type '
+                            '{0}'.format(type(doc)))
+        if doc.get('_id'):
+            result = self._update({'_id': doc['_id']}, doc, upsert=True)
+            return result if self._acknowledged(safe, kwargs) else None
+        return self._insertOne(doc)
+
+    @_deferred
+    def remove(self, spec, safe=None, single=False, flags=0, **kwargs):
+        if isinstance(spec, ObjectId):
+            spec = {'_id': spec}
+        if not isinstance(spec, dict):
+            raise TypeError('TxMongo: spec must be an instance of dict, not '
+                            '{0}'.format(type(spec)))
+        result = {'ok': 1.0, 'err': None, 'n': self._remove(spec, single)}
+        return result if self._acknowledged(safe, kwargs) else None
+
+    @_deferred
+    def find_and_modify(self, query=None, update=None, upsert=False,
+                        sort=None, new=False, remove=False, fields=None,
+                        **kwargs):
+        if not update and not remove:
+            raise ValueError('TxMongo: must either update or remove.')
+        if update and remove:
+            raise ValueError("TxMongo: can't do both update and remove.")
+        matched = self._select(query or {})
+        if sort:
+            if isinstance(sort, dict):
+                sort = sort.items()
+            matched = _sorted(matched, sort, doc=operator.itemgetter(1))
+        if not matched:
+            if upsert and update:
+                result = self._update(query or {}, update, upsert=True)
+                if new:
+                    key = _hashKey(result['upserted'])
+                    return _project(self._copy(key), fields)
+            return None
+        key, stored = matched[0]
+        before = self._copy(key)
+        if remove:
+            del self._docs[key]
+            return _project(before, fields)
+        self._update({'_id': stored['_id']}, update)
+        return _project(self._copy(key) if new else before, fields)
+
+    @_deferred
+    def aggregate(self, pipeline, full_response=False, **kwargs):
+        docs = [self._copy(i) for i in self._docs]
+        for stage in pipeline:
+            if len(stage) != 1:
+                raise OperationFailure('A pipeline stage specification object '
+                                       'must contain exactly one field.')
+            name, arg = stage.items()[0]
+            if name == '$lookup':
+                docs = self._lookup(docs, arg)
+                continue
+            run = _stages.get(name)
+            if run is None:
+                raise OperationFailure('Unrecognized pipeline stage name: %r' %
+                                       name)
+            docs = run(docs, arg)
+        if full_response:
+            return {'ok': 1.0, 'result': docs}
+        return docs
+
+    def _lookup(self, docs, spec):
+        ''' The $lookup stage, in its localField and foreignField form '''
+        if not all(k in spec for k in ('from', 'localField', 'foreignField',
+                                       'as')):
+            raise OperationFailure('$lookup needs from, localField, '
+                                   'foreignField and as here')
+        if self.backend is None:
+            raise OperationFailure('$lookup needs a collection from a '
+                                   'MemoryBackend')
+        other = self.backend.getCollection(self.dbname, spec['from'])
+        foreign = [other._copy(i) for i in other._docs]
+        for doc in docs:
+            values = []
+            for i in _values(doc, spec['localField']):
+                values.extend(i if isinstance(i, list) else [i])
+            query = {spec['foreignField']: {'$in': values or [None]}}
+            _set(doc, spec['as'], [copy.deepcopy(i) for i in foreign
+                                   if _match(i, query)])
+        return docs
+
+    def _plan(self, spec, orderby):
+        ''' A query plan for `spec` and `orderby`: an index scan when an
+        index starts with a field the query matches or sorts on '''
+        fields = set(k for k in spec if not k.startswith('$'))
+        for i in spec.get('$and', []):
+            fields.update(k for k in i if not k.startswith('$'))
+        fields.update(k for k, _ in orderby or ())
+        for name, index in self._indexes.iteritems():
+            if index['key'].keys()[0] in fields:
+                return {'stage': 'FETCH',
+                        'inputStage': {'stage': 'IXSCAN', 'indexName': name,
+                                       'keyPattern': index['key']}}
+        return {'stage': 'COLLSCAN', 'filter': spec}
+
+    @_deferred
+    def explain(self, command):
+        ''' The queryPlanner output of the explain command for a find or
+        count `command` '''
+        if 'find' in command:
+            spec, orderby = command.get('filter') or {}, command.get('sort')
+        elif 'count' in command:
+            spec, orderby = command.get('query') or {}, None
+        else:
+            raise OperationFailure('Explain only supports find and count '
+                                   'here', 2)
+        orderby = orderby.items() if isinstance(orderby, dict) else orderby
+        return {'queryPlanner': {'namespace': str(self),
+                                 'winningPlan': self._plan(spec, orderby)},
+                'ok': 1.0}
+
+    @_deferred
+    def create_index(self, sort_fields, **kwargs):
+        orderby = sort_fields['orderby']
+        name = kwargs.pop('name', None) or Collection._gen_index_name(orderby)
+        index = dict(kwargs, v=2, key=SON(orderby), name=name, ns=str(self))
+        existing = self._indexes.get(name)
+        if existing is not None:
+            if existing != index:
+                raise OperationFailure('Index with name: %s already exists '
+                                       'with different options' % name, 85)
+            return name
+        if index.get('unique'):
+            for key, (_, doc) in self._docs.iteritems():
+                self._checkUnique(key, doc, index)
+        self._indexes[name] = index
+        return name
+
+    @_deferred
+    def index_information(self):
+        return copy.deepcopy(self._indexes)
+
+    @_deferred
+    def drop_index(self, index_identifier):
+        name = index_identifier
+        if not isinstance(name, basestring):
+            name = Collection._gen_index_name(index_identifier['orderby'])
+        if name == '_id_':
+            raise OperationFailure('cannot drop _id index', 72)
+        if self._indexes.pop(name, None) is None:
+            raise OperationFailure('index not found with name [%s]' % name, 27)
+        return {'ok': 1.0}
+
+    def with_options(self, **kwargs):
+        ''' Writes apply at once, so a write concern changes nothing here '''
+        return self
+
+    @_deferred
+    def bulk_write(self, requests, ordered=True):
+        bulk = _Bulk()
+        for request in requests:
+            try:
+                request._add_to_bulk(bulk)
+            except AttributeError:
+                raise TypeError('{} is not valid request'.format(request))
+        return BulkWriteResult(self._bulk(bulk.ops, ordered), True)
+
+    def _bulk(self, ops, ordered):
+        if not ops:
+            raise InvalidOperation('No operations to execute')
+        result = {'writeErrors': [], 'writeConcernErrors': [], 'nInserted': 0,
+                  'nUpserted': 0, 'nMatched': 0, 'nModified': 0, 'nRemoved': 0,
+                  'upserted': []}
+        for index, (kind, args) in enumerate(ops):
+            try:
+                if kind == 'insert':
+                    self._insertOne(args)
+                    result['nInserted'] += 1
+                elif kind == 'update':
+                    selector, update, multi, upsert = args
+                    res = self._update(selector, update, upsert, multi)
+                    if 'upserted' in res:
+                        result['nUpserted'] += 1
+                        result['upserted'].append({'index': index,
+                                                   '_id': res['upserted']})
+                    else:
+                        result['nMatched'] += res['n']
+                        result['nModified'] += res['nModified']
+                else:
+                    selector, limit = args
+                    result['nRemoved'] += self._remove(selector, limit == 1)
+            except OperationFailure as e:
+                result['writeErrors'].append({'index': index, 'code': e.code,
+                                              'errmsg': str(e), 'op': args})
+                if ordered:
+                    break
+        if result['writeErrors']:
+            raise BulkWriteError(result)
+        return result
+
+
+class MemoryBackend(Backend):
+    ''' Collections kept in memory, created when they are first asked for '''
+
+    def __init__(self):
+        self.collections = {}
+
+    def getCollection(self, dbname, name):
+        collection = self.collections.get((dbname, name))
+        if collection is None:
+            collection = MemoryCollection(dbname, name, self)
+            self.collections[(dbname, name)] = collection
+        return collection
@@ -1,21 +1,173 @@
+import base64
+import copy
+import functools
 import txmongo
 import pytz
 import json
 import iso8601
+import time
+import warnings
 from txmongo import connection
-from collections import OrderedDict
+from txmongo.collection import Collection
+from collections import OrderedDict, namedtuple
 try:
     from txmongo._pymongo.objectid import ObjectId, InvalidId
 except ImportError:
     from bson.objectid import ObjectId, InvalidId
+from bson import BSON, SON
+from bson.errors import BSONError
+from pymongo.errors import BulkWriteError
+from pymongo.operations import UpdateOne
 from twisted.internet import defer
+from twisted.python import log
+from txmongoobject.backend import Backend, TxMongoBackend
+from twisted.python.failure import Failure
 from datetime import datetime
+from types import MemberDescriptorType
 
 
 def _all_subclasses(cls):
     return cls.__subclasses__() + [g for s in cls.__subclasses__() for g in _all_subclasses(s)]
 
 
+# Reads in flight by key, and the number of writes made through the model
+# classes by collection
+_inflight = {}
+_writes = {}
+
+
+def _queryKey(value):
+    ''' A hashable form of a query document. Keys of plain dicts are sorted,
+    so queries that only differ in key order give the same key '''
+    if value.__class__ is dict:
+        return ('{', tuple(sorted((k, _queryKey(v))
+                                  for k, v in value.iteritems())))
+    if isinstance(value, dict):
+        return ('{', tuple((k, _queryKey(v)) for k, v in value.iteritems()))
+    if isinstance(value, (list, tuple)):
+        return ('[', tuple(_queryKey(i) for i in value))
+    return (value.__class__.__name__, value)
+
+
+def _queryShape(value):
+    ''' `value` with every literal replaced by 1, leaving the field names and
+    operators the query was built from '''
+    if isinstance(value, dict):
+        return dict((k, _queryShape(v)) for k, v in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        if any(isinstance(i, (dict, list, tuple)) for i in value):
+            return [_queryShape(i) for i in value]
+        return [1]
+    return 1
+
+
+_observers = []
+
+
+def addObserver(observer):
+    ''' Call `observer` with an event dict when a findOne, load, find, save,
+    loadRefs, count, aggregate or write buffer flush starts, and again when
+    it finishes.
+
+    Every event has `event` ('start' or 'finish'), `class`, `collection`,
+    `operation` and `query`, the shape of the query from `_queryShape`.
+    Finish events add the number of `documents` and `bytes` of BSON
+    returned, the `duration` in seconds split into `network`, waiting on
+    the server, and `python`, everything else, and `failure`, a Failure if
+    the operation failed and None otherwise '''
+    _observers.append(observer)
+
+
+def removeObserver(observer):
+    _observers.remove(observer)
+
+
+def _begin(cls, operation, query=None):
+    ''' Start reporting an operation to the observers '''
+    if not _observers:
+        return _noOperation
+    return _Operation(cls, operation, query)
+
+
+class _Operation(object):
+
+    def __init__(self, cls, operation, query):
+        self.event = {'class': cls, 'collection': cls.collection,
+                      'operation': operation, 'query': _queryShape(query)}
+        self.network = 0.0
+        self.finished = False
+        self.started = time.time()
+        self._emit(dict(self.event, event='start'))
+
+    def wait(self, d):
+        ''' Count the time until `d` fires as network time. A failure
+        finishes the operation '''
+        started = time.time()
+
+        def _done(result):
+            self.network += time.time() - started
+            if isinstance(result, Failure):
+                self.finish(failure=result)
+            return result
+        return d.addBoth(_done)
+
+    def finish(self, docs=(), failure=None):
+        if self.finished:
+            return
+        self.finished = True
+        duration = time.time() - self.started
+        self._emit(dict(self.event, event='finish', documents=len(docs),
+                        bytes=sum(len(BSON.encode(i)) for i in docs),
+                        duration=duration, network=self.network,
+                        python=duration - self.network, failure=failure))
+
+    @staticmethod
+    def _emit(event):
+        for observer in list(_observers):
+            try:
+                observer(event)
+            except Exception:
+                log.err(None, 'Error in txmongoobject observer %r' %
+                        (observer, ))
+
+
+class _NoOperation(object):
+    ''' Stands in for _Operation when nothing is observing '''
+
+    def wait(self, d):
+        return d
+
+    def finish(self, docs=(), failure=None):
+        pass
+
+
+_noOperation = _NoOperation()
+
+
+def _coalesce(key, fetch):
+    ''' Call `fetch` once for everyone who asks for `key` while the first
+    call is in flight. The first caller gets the result, the others a deep
+    copy of it '''
+    waiters = _inflight.get(key)
+    if waiters is not None:
+        d = defer.Deferred()
+        waiters.append(d)
+        return d
+    waiters = _inflight[key] = []
+
+    def _done(result):
+        del _inflight[key]
+        for d in waiters:
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(copy.deepcopy(result))
+        return result
+    d = defer.maybeDeferred(fetch)
+    d.addBoth(_done)
+    return d
+
+
 class MongoEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, ObjectId):
@@ -35,7 +187,16 @@ class DocumentExists(Exception):
     pass
 
 
+class CollectionScanWarning(RuntimeWarning):
+    ''' A query of a class with `explain_queries` on scans its whole
+    collection '''
+
+
 class metaMongoObj(type):
+
+    # Model classes by (collection, class name), for unmarshalling
+    registry = {}
+
     def __new__(meta, classname, bases, classDict):
         classDict['_id'] = mongoidProperty()
         classDict['cdate'] = dateProperty()
@@ -49,11 +210,541 @@ class metaMongoObj(type):
         if classDict["collection"] != classname:
             classDict["_unmarshal_class"] = stringProperty(default=classname)
 
+        compactBases = [i for i in bases if getattr(i, 'compact', False)]
+        compact = classDict.get('compact', bool(compactBases))
+        if compactBases and not compact:
+            # Instances would inherit the slots of the compact base
+            raise TypeError('%s cannot set compact = False, %s is compact' %
+                            (classname, compactBases[0].__name__))
+        if compact and '__slots__' not in classDict:
+            if not compactBases:
+                slots = [i for i in _compactAttrs if i not in classDict]
+                classDict['__slots__'] = ['_values', '_dirty_mask'] + slots
+                classDict['_prop_data'] = property(_compactData)
+                classDict['_prop_dirty'] = property(_compactDirty)
+            elif not any(i in classDict for i in _compactAttrs):
+                classDict['__slots__'] = ()
+
         for k, v in classDict.iteritems():
             if not issubclass(v.__class__, mongoProperty):
                 continue
             v._name = v._key if v._key else k
-        return type.__new__(meta, classname, bases, classDict)
+        cls = type.__new__(meta, classname, bases, classDict)
+        cls._compiled_schema = MongoSchema(cls)
+        if compact:
+            base = compactBases[0] if compactBases else None
+            cls._slotIndex = dict(base._slotIndex) if base else {}
+            cls._slotKeys = list(base._slotKeys) if base else []
+            for i in cls._compiled_schema.fields:
+                cls._addSlot(i.key)
+            cls._slotDefaults = tuple(
+                (i, _classDefault(cls, i)) for i in _compactAttrs
+                if isinstance(getattr(cls, i, None), MemberDescriptorType))
+        meta._register(cls)
+        return cls
+
+    @classmethod
+    def _register(meta, cls):
+        key = (cls.collection, cls.__name__)
+        existing = meta.registry.get(key)
+        if existing is not None and existing.__module__ != cls.__module__:
+            warnings.warn('%s.%s and %s.%s both unmarshal documents in %s as '
+                          '%s' % (existing.__module__, existing.__name__,
+                                  cls.__module__, cls.__name__,
+                                  cls.collection, cls.__name__),
+                          RuntimeWarning)
+        meta.registry[key] = cls
+
+    def _addSlot(cls, key):
+        ''' Give `key` an index in the values of a compact class. Indexes
+        are never reused, so existing instances stay valid '''
+        if key not in cls._slotIndex:
+            cls._slotIndex[key] = len(cls._slotKeys)
+            cls._slotKeys.append(key)
+
+    def __setattr__(cls, name, value):
+        if issubclass(value.__class__, mongoProperty):
+            value._name = value._key if value._key else name
+            if cls.compact:
+                for i in [cls] + _all_subclasses(cls):
+                    i._addSlot(value._name)
+        invalidate = issubclass(value.__class__, mongoProperty) or \
+            issubclass(cls.__dict__.get(name).__class__, mongoProperty)
+        super(metaMongoObj, cls).__setattr__(name, value)
+        if invalidate:
+            cls._invalidate_schema()
+
+    def __delattr__(cls, name):
+        invalidate = issubclass(cls.__dict__.get(name).__class__,
+                                mongoProperty)
+        super(metaMongoObj, cls).__delattr__(name)
+        if invalidate:
+            cls._invalidate_schema()
+
+    def _invalidate_schema(cls):
+        ''' Drop the compiled schema of this class and every subclass. They
+        are recompiled the next time they are needed '''
+        for i in [cls] + _all_subclasses(cls):
+            type.__setattr__(i, '_compiled_schema', None)
+
+
+def _checkLoaded(instance, name):
+    ''' Raise `notLoadedError` if `name` was left out of a partial load '''
+    loaded = instance._loaded_fields
+    if loaded is not None and name not in loaded:
+        raise notLoadedError('%s was not loaded' % name)
+
+
+# Instance attributes that compact classes keep in slots
+_compactAttrs = ('loaded', 'display_timezone', '_session', '_loaded_fields')
+
+# Marks an unset value in the values of a compact object
+_missing = object()
+
+
+def _classDefault(cls, name):
+    ''' The class level value of `name`, looking past slot descriptors '''
+    for i in cls.__mro__:
+        value = i.__dict__.get(name, _missing)
+        if value is not _missing and \
+                not isinstance(value, MemberDescriptorType):
+            return value
+    return None
+
+
+class _compactData(object):
+    ''' The `_prop_data` of a compact object: a dict-like view of the values
+    it keeps in a list, indexed by the class's `_slotIndex` '''
+
+    __slots__ = ('_obj',)
+
+    def __init__(self, obj):
+        self._obj = obj
+
+    def __contains__(self, key):
+        index = self._obj._slotIndex.get(key)
+        values = self._obj._values
+        return index is not None and index < len(values) and \
+            values[index] is not _missing
+
+    def __getitem__(self, key):
+        index = self._obj._slotIndex.get(key)
+        values = self._obj._values
+        if index is None or index >= len(values) or values[index] is _missing:
+            raise KeyError(key)
+        return values[index]
+
+    def __setitem__(self, key, value):
+        index = self._obj._slotIndex[key]
+        values = self._obj._values
+        if index >= len(values):
+            values.extend([_missing] * (index + 1 - len(values)))
+        values[index] = value
+
+    def __delitem__(self, key):
+        self[key]
+        self._obj._values[self._obj._slotIndex[key]] = _missing
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def keys(self):
+        return [k for k, v in zip(self._obj._slotKeys, self._obj._values)
+                if v is not _missing]
+
+    def items(self):
+        return [(k, v) for k, v in zip(self._obj._slotKeys, self._obj._values)
+                if v is not _missing]
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def clear(self):
+        values = self._obj._values
+        values[:] = [_missing] * len(values)
+
+
+class _compactDirty(object):
+    ''' The `_prop_dirty` of a compact object: a set-like view of a bitmask
+    indexed by the class's `_slotIndex` '''
+
+    __slots__ = ('_obj',)
+
+    def __init__(self, obj):
+        self._obj = obj
+
+    def __contains__(self, key):
+        index = self._obj._slotIndex.get(key)
+        return index is not None and bool(self._obj._dirty_mask >> index & 1)
+
+    def add(self, key):
+        self._obj._dirty_mask |= 1 << self._obj._slotIndex[key]
+
+    def discard(self, key):
+        index = self._obj._slotIndex.get(key)
+        if index is not None:
+            self._obj._dirty_mask &= ~(1 << index)
+
+    def remove(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.discard(key)
+
+    def update(self, keys):
+        for i in keys:
+            self.add(i)
+
+    def difference_update(self, keys):
+        for i in keys:
+            self.discard(i)
+
+    def clear(self):
+        self._obj._dirty_mask = 0
+
+    def __iter__(self):
+        mask = self._obj._dirty_mask
+        return iter([k for i, k in enumerate(self._obj._slotKeys)
+                     if mask >> i & 1])
+
+    def __len__(self):
+        return bin(self._obj._dirty_mask).count('1')
+
+    def __eq__(self, other):
+        return set(self) == set(other)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+
+def _pathKey(key):
+    ''' `key` as part of a dotted path, or None when it cannot be one '''
+    if isinstance(key, basestring) and '.' not in key and \
+            not key.startswith('$'):
+        return key
+    return None
+
+
+def _dotted(path):
+    return '.'.join(i if isinstance(i, basestring) else str(i) for i in path)
+
+
+class _changeLog(object):
+    ''' The changes made inside the value of one dict or list property since
+    it was loaded. Paths are tuples of keys and list indexes starting with
+    the property's key. A None in a path stands for a key that cannot be
+    part of a dotted path, so the change is recorded on its parent '''
+
+    __slots__ = ('sets', 'unsets', 'pushes', 'pulls')
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.sets = set()
+        self.unsets = set()
+        self.pushes = {}
+        self.pulls = {}
+
+    def __nonzero__(self):
+        return bool(self.sets or self.unsets or self.pushes or self.pulls)
+
+    def changed(self, path):
+        if None in path:
+            path = path[:path.index(None)]
+        self.sets.add(path)
+        self.unsets.discard(path)
+
+    def removed(self, path):
+        if None in path:
+            return self.changed(path)
+        # Changes made inside the removed value go with it
+        n = len(path)
+        self.sets = set(i for i in self.sets if i[:n] != path)
+        self.unsets = set(i for i in self.unsets if i[:n] != path)
+        for changes in (self.pushes, self.pulls):
+            for i in [i for i in changes if i[:n] == path]:
+                del changes[i]
+        self.unsets.add(path)
+
+    def appended(self, path, count):
+        if None in path:
+            return self.changed(path)
+        self.pushes[path] = self.pushes.get(path, 0) + count
+
+    def pulled(self, path, value):
+        if None in path:
+            return self.changed(path)
+        self.pulls.setdefault(path, []).append(value)
+
+    def collect(self, root, ops, prefix, field):
+        ''' Add the update operations for these changes to `ops`. `root` is
+        the property value the paths start from '''
+        sets = set(self.sets)
+        changed = self.sets | self.unsets
+        moved = set(self.pushes) | set(self.pulls)
+        for path in moved:
+            # A list that was appended to or pulled from and also changed
+            # some other way, or that holds a list that was, is rewritten
+            # whole. Mongo rejects updates whose paths overlap
+            n = len(path)
+            if path in self.pushes and path in self.pulls or \
+                    any(i[:n] == path for i in changed) or \
+                    any(i[:n] == path and i != path for i in moved):
+                sets.add(path)
+
+        def covered(path):
+            return any(path[:i] in sets or path[:i] in self.unsets
+                       for i in range(1, len(path)))
+
+        for path in sets:
+            if not covered(path):
+                value = _resolve(root, path)
+                ops['$set'][prefix + _dotted(path)] = \
+                    _serialize(field, path, value)
+        for path in self.unsets:
+            if not covered(path):
+                ops['$unset'][prefix + _dotted(path)] = ''
+        for path, count in self.pushes.iteritems():
+            if path not in sets and not covered(path):
+                values = _resolve(root, path)[-count:]
+                ops['$push'][prefix + _dotted(path)] = {
+                    '$each': [_serialize(field, path + (0, ), i)
+                              for i in values]}
+        for path, values in self.pulls.iteritems():
+            if path not in sets and not covered(path):
+                values = [_serialize(field, path + (0, ), i) for i in values]
+                ops['$pull'][prefix + _dotted(path)] = \
+                    values[0] if len(values) == 1 else {'$in': values}
+
+
+def _resolve(root, path):
+    value = root
+    for i in path[1:]:
+        value = value[i]
+    return value
+
+
+def _serialize(field, path, value):
+    ''' `value` at `path` in `field` as stored in mongo '''
+    if field.isRefList:
+        if len(path) == 1:
+            return field.prop._getIds(value)
+        if len(path) == 2 and value is not None and \
+                not isinstance(value, ObjectId):
+            return value._id
+    return _untrack(value)
+
+
+def _track(value, log, path):
+    ''' A copy of `value` that records changes to `log`, if it is a dict or
+    list '''
+    cls = value.__class__
+    if cls is dict or cls is _trackedDict:
+        out = _trackedDict()
+        out._log = log
+        out._path = path
+        dict.update(out, [(k, _track(v, log, path + (_pathKey(k), ))
+                           if v.__class__ in _containers else v)
+                          for k, v in dict.iteritems(value)])
+        return out
+    if cls is list or cls is _trackedList:
+        out = _trackedList()
+        out._log = log
+        out._path = path
+        list.extend(out, [_track(v, log, path + (i, ))
+                          if v.__class__ in _containers else v
+                          for i, v in enumerate(value)])
+        return out
+    return value
+
+
+def _repath(value, path):
+    ''' Give a tracked value and the tracked values inside it new paths '''
+    if value.__class__ is _trackedDict:
+        value._path = path
+        for k, v in dict.iteritems(value):
+            _repath(v, path + (_pathKey(k), ))
+    elif value.__class__ is _trackedList:
+        value._path = path
+        for i, v in enumerate(value):
+            _repath(v, path + (i, ))
+
+
+def _detach(value):
+    ''' Stop a tracked value that was replaced or removed from recording
+    changes to its property '''
+    if value.__class__ is _trackedDict or value.__class__ is _trackedList:
+        _relog(value, _changeLog())
+        _repath(value, ())
+
+
+def _relog(value, log):
+    value._log = log
+    if value.__class__ is _trackedDict:
+        value = value.itervalues()
+    for i in value:
+        if i.__class__ is _trackedDict or i.__class__ is _trackedList:
+            _relog(i, log)
+
+
+def _untrack(value):
+    ''' A plain copy of a tracked value '''
+    if value.__class__ is _trackedDict:
+        return dict((k, _untrack(v)) for k, v in dict.iteritems(value))
+    if value.__class__ is _trackedList:
+        return [_untrack(i) for i in value]
+    return value
+
+
+class _trackedDict(dict):
+    ''' The value of a dict property, recording changes to its `_changeLog`.
+    Dicts and lists stored in it are copied, and tracked too '''
+
+    __slots__ = ('_log', '_path')
+
+    def __reduce__(self):
+        return (dict, (_untrack(self), ))
+
+    def __setitem__(self, key, value):
+        path = self._path + (_pathKey(key), )
+        old = dict.get(self, key)
+        dict.__setitem__(self, key, _track(value, self._log, path))
+        _detach(old)
+        self._log.changed(path)
+
+    def __delitem__(self, key):
+        _detach(dict.get(self, key))
+        dict.__delitem__(self, key)
+        self._log.removed(self._path + (_pathKey(key), ))
+
+    def pop(self, key, *default):
+        if key in self:
+            _detach(dict.__getitem__(self, key))
+            self._log.removed(self._path + (_pathKey(key), ))
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        _detach(value)
+        self._log.removed(self._path + (_pathKey(key), ))
+        return key, value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def update(self, *args, **kwargs):
+        for k, v in dict(*args, **kwargs).iteritems():
+            self[k] = v
+
+    def clear(self):
+        for i in dict.itervalues(self):
+            _detach(i)
+        dict.clear(self)
+        self._log.changed(self._path)
+
+
+class _trackedList(list):
+    ''' The value of a list property, recording changes to its `_changeLog`.
+    Appends become a `$push` and removing the only occurrence of a plain
+    value becomes a `$pull`; anything that moves items rewrites the list '''
+
+    __slots__ = ('_log', '_path')
+
+    def __reduce__(self):
+        return (list, (_untrack(self), ))
+
+    def _rewritten(self):
+        _repath(self, self._path)
+        self._log.changed(self._path)
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            old = list.__getitem__(self, index)
+            list.__setitem__(self, index,
+                             [_track(i, self._log, ()) for i in value])
+            map(_detach, old)
+            return self._rewritten()
+        if index < 0:
+            index += len(self)
+        path = self._path + (index, )
+        old = list.__getitem__(self, index)
+        list.__setitem__(self, index, _track(value, self._log, path))
+        _detach(old)
+        self._log.changed(path)
+
+    def __setslice__(self, i, j, values):
+        self.__setitem__(slice(i, j), values)
+
+    def __delitem__(self, index):
+        old = list.__getitem__(self, index)
+        list.__delitem__(self, index)
+        map(_detach, old if isinstance(index, slice) else [old])
+        self._rewritten()
+
+    def __delslice__(self, i, j):
+        map(_detach, list.__getslice__(self, i, j))
+        list.__delslice__(self, i, j)
+        self._rewritten()
+
+    def __iadd__(self, values):
+        self.extend(values)
+        return self
+
+    def __imul__(self, count):
+        list.__imul__(self, count)
+        self._rewritten()
+        return self
+
+    def append(self, value):
+        list.append(self, _track(value, self._log, self._path + (len(self), )))
+        self._log.appended(self._path, 1)
+
+    def extend(self, values):
+        start = len(self)
+        values = [_track(v, self._log, self._path + (start + i, ))
+                  for i, v in enumerate(values)]
+        list.extend(self, values)
+        if values:
+            self._log.appended(self._path, len(values))
+
+    def insert(self, index, value):
+        list.insert(self, index, _track(value, self._log, ()))
+        self._rewritten()
+
+    def pop(self, *index):
+        value = list.pop(self, *index)
+        _detach(value)
+        self._rewritten()
+        return value
+
+    def remove(self, value):
+        index = self.index(value)
+        old = list.__getitem__(self, index)
+        list.__delitem__(self, index)
+        _detach(old)
+        if value.__class__ in _containers or value in self:
+            return self._rewritten()
+        _repath(self, self._path)
+        self._log.pulled(self._path, value)
+
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        self._rewritten()
+
+    def reverse(self):
+        list.reverse(self)
+        self._rewritten()
+
+
+_containers = (dict, list, _trackedDict, _trackedList)
 
 
 class mongoProperty(object):
@@ -61,12 +752,19 @@ class mongoProperty(object):
     value = None
     _name = None
     _key = None
+    # The kind of index `index=True` declares
+    _indexType = 1
 
-    def __init__(self, allowNone=True, default=None, key=None):
+    def __init__(self, allowNone=True, default=None, key=None, index=False,
+                 unique=False, sparse=False):
         self.allowNone = allowNone
         self.default = default
         if key:
             self._key = key
+        # Declare an index on this property for ensure_indexes
+        self.index = index or unique or sparse
+        self.unique = unique
+        self.sparse = sparse
 
     def set(self, value):
         if value is None and self.default is not None:
@@ -79,16 +777,21 @@ class mongoProperty(object):
     def __set__(self, instance, value):
         if not self._name:
             return
-        if instance.loaded and (self._name not in instance._prop_data or instance._prop_data[self._name] != self.set(value)):
+        data = instance._prop_data
+        value = self.set(value)
+        if instance.loaded and \
+                (self._name not in data or data[self._name] != value):
             instance._prop_dirty.add(self._name)
-        instance._prop_data[self._name] = self.set(value)
+        data[self._name] = value
 
     def __get__(self, instance, owner):
-        if self._name not in instance._prop_data:
+        data = instance._prop_data
+        if self._name not in data:
+            _checkLoaded(instance, self._name)
             val = self.get(self.default)
-            instance._prop_data[self._name] = val
+            data[self._name] = val
             return val
-        return self.get(instance._prop_data[self._name])
+        return self.get(data[self._name])
 
 
 class boolProperty(mongoProperty):
@@ -136,10 +839,12 @@ class dateProperty(mongoProperty):
         return value
 
     def __get__(self, instance, owner):
-        if self._name not in instance._prop_data:
+        data = instance._prop_data
+        if self._name not in data:
+            _checkLoaded(instance, self._name)
             return self.default
 
-        value = self.get(instance._prop_data[self._name])
+        value = self.get(data[self._name])
 
         if not isinstance(value, datetime):
             return value
@@ -266,10 +971,32 @@ class referenceProperty(mongoProperty):
         return value
 
 
-class dictProperty(mongoProperty):
+class _trackedProperty(mongoProperty):
+    ''' A property whose dict or list values record the changes made inside
+    them, so that saving sends dotted-path updates instead of the whole
+    value '''
+
+    def __set__(self, instance, value):
+        old = instance._prop_data.get(self._name) if instance.loaded else None
+        mongoProperty.__set__(self, instance, value)
+        if getattr(old, '_log', None):
+            # The changes made inside the old value are lost
+            instance._prop_dirty.add(self._name)
+
+    def __get__(self, instance, owner):
+        value = mongoProperty.__get__(self, instance, owner)
+        if value.__class__ is dict or value.__class__ is list:
+            value = _track(value, _changeLog(), (self._name, ))
+            instance._prop_data[self._name] = value
+        return value
+
+
+class dictProperty(_trackedProperty):
 
     def set(self, value):
-        if value.__class__ is not dict:
+        if value.__class__ is _trackedDict:
+            value = _untrack(value)
+        elif value.__class__ is not dict:
             value = None
 
         if not self.allowNone and value is None:
@@ -282,7 +1009,7 @@ class dictProperty(mongoProperty):
         return value
 
 
-class listProperty(mongoProperty):
+class listProperty(_trackedProperty):
 
     _defaultWrapper = None
 
@@ -297,6 +1024,8 @@ class listProperty(mongoProperty):
         super(listProperty, self).__init__(*args, **kwargs)
 
     def set(self, value):
+        if value.__class__ is _trackedList:
+            value = _untrack(value)
         if value.__class__ is not list:
             value = None
         elif self._defaultWrapper is not None:
@@ -325,6 +1054,9 @@ class listProperty(mongoProperty):
 
 class geoPointProperty(mongoProperty):
     ''' Point GeoJSON object, with GeoJSON metadata hidden '''
+
+    _indexType = '2dsphere'
+
     def set(self, value):
         if isinstance(value, dict) and 'coordinates' in value and 'type' in value:
             # Allow raw GeoJSON to get through
@@ -344,44 +1076,319 @@ class geoPointProperty(mongoProperty):
     #     return value['coordinates']
 
 
+schemaField = namedtuple('schemaField', ['attr', 'key', 'prop', 'isReference',
+                                         'isList', 'isRefList', 'isObject',
+                                         'isDate'])
+
+
+class MongoSchema(object):
+    ''' The properties of a model class, compiled once per class.
+
+    `fields` is ordered base class first, and resolves names the same way
+    attribute lookup does, so a subclass overriding a property wins. '''
+
+    __slots__ = ('fields', 'byAttr', 'byKey', 'keyToAttr', 'attrToKey',
+                 'references', 'refLists', 'objects', 'dates', 'tracked',
+                 'codec')
+
+    def __init__(self, cls):
+        attrs = []
+        seen = set()
+        for i in reversed(cls.__mro__):
+            for k in sorted(i.__dict__):
+                if k not in seen:
+                    seen.add(k)
+                    attrs.append(k)
+
+        fields = []
+        for k in attrs:
+            for i in cls.__mro__:
+                if k in i.__dict__:
+                    prop = i.__dict__[k]
+                    break
+            if not issubclass(prop.__class__, mongoProperty):
+                continue
+            isRefList = isinstance(prop, listProperty) and \
+                isinstance(prop._defaultWrapper, referenceProperty)
+            fields.append(schemaField(
+                attr=k,
+                key=prop._key if prop._key else k,
+                prop=prop,
+                isReference=isinstance(prop, referenceProperty),
+                isList=isinstance(prop, listProperty),
+                isRefList=isRefList,
+                isObject=isinstance(prop, objectProperty),
+                isDate=isinstance(prop, dateProperty)))
+
+        self.fields = tuple(fields)
+        self.byAttr = dict((i.attr, i) for i in fields)
+        self.byKey = dict((i.key, i) for i in fields)
+        self.keyToAttr = dict((i.key, i.attr) for i in fields)
+        self.attrToKey = dict((i.attr, i.key) for i in fields)
+        self.references = tuple(i for i in fields if i.isReference)
+        self.refLists = tuple(i for i in fields if i.isRefList)
+        self.objects = tuple(i for i in fields if i.isObject)
+        self.dates = tuple(i for i in fields if i.isDate)
+        self.tracked = tuple(i for i in fields if i.isObject or
+                             isinstance(i.prop, _trackedProperty))
+        self.codec = _jsonCodec(self)
+
+
+def _oidJson(value):
+    return None if value is None else {"$oid": str(value)}
+
+
+def _parseDate(value):
+    ''' Parse the output of `datetime.isoformat()` for naive or UTC
+    datetimes, and anything else with iso8601 '''
+    n = len(value)
+    if n in (25, 32) and value.endswith('+00:00'):
+        value = value[:-6]
+        n -= 6
+    if (n == 19 or n == 26 and value[19] == '.') and value[10] == 'T' and \
+            value[4] == value[7] == '-' and value[13] == value[16] == ':':
+        try:
+            return datetime(int(value[0:4]), int(value[5:7]),
+                            int(value[8:10]), int(value[11:13]),
+                            int(value[14:16]), int(value[17:19]),
+                            int(value[20:26]) if n == 26 else 0,
+                            tzinfo=pytz.utc)
+        except ValueError:
+            pass
+    return iso8601.parse_date(value)
+
+
+class _jsonCodec(object):
+    ''' Encodes and decodes the extended JSON of one model class, converting
+    the fields the schema knows are ObjectIds, references and dates directly
+    and walking only dict, list and embedded object values generically '''
+
+    def __init__(self, schema):
+        self._encoders = []
+        self._decoders = {}
+        for field in schema.fields:
+            prop = field.prop
+            if field.isReference:
+                encode = self._encodeReference
+                decode = self._decodeId
+            elif field.isRefList:
+                encode = self._encodeRefList(prop)
+                decode = self._decodeIdList
+            elif field.isList:
+                encode = self._encodeList(prop)
+                decode = self._decodeGeneric
+            elif field.isObject:
+                encode = self._encodeObject
+                decode = self._decodeGeneric
+            elif field.isDate:
+                encode = self._encodeDate
+                decode = self._decodeDate
+            elif isinstance(prop, mongoidProperty):
+                encode = _oidJson
+                decode = self._decodeId
+            elif isinstance(prop, (stringProperty, intProperty, floatProperty,
+                                   boolProperty)):
+                encode = None
+                decode = None
+            else:
+                encode = None
+                decode = self._decodeGeneric
+            self._encoders.append((field.attr, field.key, encode))
+            if decode is not None:
+                self._decoders[field.key] = decode
+
+    def encode(self, obj):
+        ''' The same output as
+        `json.dumps(obj.getValues(), cls=MongoEncoder)` '''
+        out = {}
+        partial = obj._loaded_fields is not None
+        for attr, key, encode in self._encoders:
+            if partial and not obj._isLoaded(key):
+                continue
+            value = getattr(obj, attr)
+            out[key] = value if encode is None else encode(value)
+        return json.dumps(out, cls=MongoEncoder)
+
+    def decode(self, data):
+        doc = json.loads(data)
+        decoders = self._decoders
+        for key, value in doc.items():
+            decode = decoders.get(key)
+            if decode is not None and value is not None:
+                doc[key] = decode(value)
+        return doc
+
+    @staticmethod
+    def _encodeReference(value):
+        if value is None or isinstance(value, ObjectId):
+            return _oidJson(value)
+        return _oidJson(value._id)
+
+    @staticmethod
+    def _encodeRefList(prop):
+        def encode(value):
+            value = prop._getIds(value)
+            if value is None:
+                return None
+            return [_oidJson(i) for i in value]
+        return encode
+
+    @staticmethod
+    def _encodeList(prop):
+        def encode(value):
+            return prop._getIds(value)
+        return encode
+
+    @staticmethod
+    def _encodeObject(value):
+        return None if value is None else value.getValues()
+
+    @staticmethod
+    def _encodeDate(value):
+        if isinstance(value, datetime):
+            return {"$date": value.isoformat()}
+        return value
+
+    @staticmethod
+    def _decodeGeneric(value):
+        return MongoSubObj._object_hook({'value': value})['value']
+
+    @classmethod
+    def _decodeId(cls, value):
+        if value.__class__ is dict and "$oid" in value:
+            return ObjectId(value["$oid"])
+        return cls._decodeGeneric(value)
+
+    @classmethod
+    def _decodeIdList(cls, value):
+        if value.__class__ is not list:
+            return cls._decodeGeneric(value)
+        return [cls._decodeId(i) if i is not None else None for i in value]
+
+    @classmethod
+    def _decodeDate(cls, value):
+        if value.__class__ is dict and "$date" in value and \
+                "$oid" not in value:
+            return _parseDate(value["$date"])
+        return cls._decodeGeneric(value)
+
+
 class MongoSubObj(object):
 
     _prop_data = {}
     _prop_dirty = set()
+    _session = None
+    _loaded_fields = None
+    # The object an embedded object is stored in
+    _parent = None
+
+    def __init__(self):
+        self._prop_data = {}
+        self._prop_dirty = set()
+        self._schema()
+
+    @property
+    def loaded(self):
+        ''' Embedded objects track changes once the object holding them
+        is loaded '''
+        return self._parent is not None and self._parent.loaded
+
+    @classmethod
+    def _schema(cls):
+        ''' The compiled schema for this class '''
+        schema = cls.__dict__.get('_compiled_schema')
+        if schema is None:
+            schema = MongoSchema(cls)
+            type.__setattr__(cls, '_compiled_schema', schema)
+            for i in schema.fields:
+                # Embedded classes have no metaclass to name their properties
+                if i.prop._name is None:
+                    i.prop._name = i.key
+        return schema
 
     def getValues(self):
         ''' Serialize all of the values into a mongoable dict '''
         out = {}
+        partial = self._loaded_fields is not None
 
-        for k, v in self.schema.iteritems():
-            key = v._key if v._key else k
-            if isinstance(v, referenceProperty):
-                tmp = getattr(self, k)
+        for field in self._schema().fields:
+            if partial and not self._isLoaded(field.key):
+                continue
+            tmp = getattr(self, field.attr)
+            if field.isReference:
                 if tmp is None or isinstance(tmp, ObjectId):
-                    out[key] = tmp
+                    out[field.key] = tmp
                 else:
-                    out[key] = tmp._id
-            elif isinstance(v, listProperty):
-                tmp = getattr(self, k)
-                out[key] = v._getIds(tmp)
-            elif issubclass(v.__class__, objectProperty):
-                out[key] = getattr(self, k).getValues()
+                    out[field.key] = tmp._id
+            elif field.isList:
+                out[field.key] = field.prop._getIds(tmp)
+            elif field.isObject:
+                out[field.key] = None if tmp is None else tmp.getValues()
             else:
-                out[key] = getattr(self, k)
+                out[field.key] = tmp
 
         return out
 
+    def _collectChanges(self, ops, prefix='', data=None):
+        ''' Add the changes made since the object was loaded to `ops`, a
+        dict of {update operator: {dotted path: value}}. Dirty fields are set
+        whole from `data`, the output of getValues, and changes inside dicts,
+        lists and embedded objects get their own paths '''
+        dirty = self._prop_dirty
+        if dirty:
+            if data is None:
+                data = self.getValues()
+            for i in dirty:
+                if i in data:
+                    ops['$set'][prefix + i] = data[i]
+        stored = self._prop_data
+        for field in self._schema().tracked:
+            if field.key in dirty:
+                continue
+            value = stored.get(field.key)
+            if field.isObject:
+                if value is not None:
+                    value._collectChanges(ops, prefix + field.key + '.')
+            elif value.__class__ in _containers and \
+                    getattr(value, '_log', None):
+                value._log.collect(value, ops, prefix, field)
+
+    def _hasChanges(self):
+        ''' True if saving would write anything '''
+        if self._prop_dirty:
+            return True
+        stored = self._prop_data
+        for field in self._schema().tracked:
+            value = stored.get(field.key)
+            if field.isObject:
+                if value is not None and value._hasChanges():
+                    return True
+            elif getattr(value, '_log', None):
+                return True
+        return False
+
+    def _clearChanges(self):
+        ''' Forget the changes made since the object was loaded, once they
+        are saved '''
+        self._prop_dirty.clear()
+        stored = self._prop_data
+        for field in self._schema().tracked:
+            value = stored.get(field.key)
+            if field.isObject:
+                if value is not None:
+                    value._clearChanges()
+            elif value.__class__ is _trackedDict or \
+                    value.__class__ is _trackedList:
+                value._log.clear()
+
     def setValues(self, data):
         ''' Set the values of the object recursively '''
-        schema = self.schema
-        keymap = {}
-        for k, v in schema.items():
-            key = v._key if v._key else k
-            keymap[key] = k
+        byKey = self._schema().byKey
         for k, v in data.iteritems():
-            if k not in keymap:
+            field = byKey.get(k)
+            if field is None:
                 continue
-            setattr(self, keymap[k], v)
+            field.prop.__set__(self, v)
 
     def __iter__(self):
         def iterKeys():
@@ -393,53 +1400,22 @@ class MongoSubObj(object):
         return len(self.getKeys())
 
     def getKeys(self):
-        out = []
-        for k, v in self.__class__.__dict__.iteritems():
-            if not issubclass(v.__class__, mongoProperty):
-                continue
-            out.append(k)
-        return out
+        return [i.attr for i in self._schema().fields if self._isLoaded(i.key)]
 
-    @defer.inlineCallbacks
-    def loadRefs(self):
-        ''' Load references that are defined in this object '''
-
-        for k, v in self.schema.iteritems():
-            if isinstance(v, listProperty) and isinstance(v._defaultWrapper, referenceProperty):
-                val = getattr(self, k)
-                if val is None:
-                    val = []
-                tmp = []
-                for i in val:
-                    if i is None or isinstance(i, v._defaultWrapper._refCls):
-                        tmp.append(i)
-                        continue
-                    row = yield v._defaultWrapper._refCls().load(i)
-                    tmp.append(row)
-                setattr(self, k, tmp)
-                continue
-            if not isinstance(v, referenceProperty):
-                continue
-            val = getattr(self, k)
-            if val is None or isinstance(val, v._refCls):
-                continue
-            try:
-                tmp = yield v._refCls().load(val)
-            except KeyError:
-                tmp = None
-            setattr(self, k, tmp)
+    def _isLoaded(self, key):
+        ''' False if a partial load left `key` out and it was never set '''
+        return self._loaded_fields is None or key in self._loaded_fields or \
+            key in self._prop_data
+
+    def loadRefs(self, concurrency=None):
+        ''' Load references that are defined in this object, running up to
+        `concurrency` lookups at once '''
+        return loadAllRefs([self], session=self._session,
+                           concurrency=concurrency)
 
     @property
     def schema(self):
-        out = {}
-        for i in self.__class__.__mro__:
-            if not issubclass(i, MongoSubObj):
-                continue
-            for k, v in i.__dict__.iteritems():
-                if not issubclass(v.__class__, mongoProperty):
-                    continue
-                out[k] = v
-        return out
+        return dict((i.attr, i.prop) for i in self._schema().fields)
 
     def create(self, data):
         ''' Called when the object is first created. All data will be
@@ -447,12 +1423,12 @@ class MongoSubObj(object):
         return data
 
     def as_json(self):
-        return json.dumps(self.getValues(), cls=MongoEncoder)
+        return self._schema().codec.encode(self)
 
     @classmethod
     def from_json(cls, data):
         obj = cls()
-        out = json.loads(data, object_hook=cls._object_hook)
+        out = cls._schema().codec.decode(data)
         obj.setValues(out)
         return obj
 
@@ -474,16 +1450,175 @@ class MongoSubObj(object):
 
 
 class objectProperty(mongoProperty):
-    ''' An embedded object property '''
+    ''' An embedded object property. Values are instances of `refClass`,
+    and can be set from a dict of their values '''
 
-    def __init__(self, refClass=None, allowNone=False):
+    def __init__(self, refClass=None, allowNone=False, key=None, **kwargs):
         if not issubclass(refClass, MongoSubObj):
             raise ValueError('refClass must be a subclass of MongoSubObj')
-        self.value = refClass()
+        super(objectProperty, self).__init__(allowNone=allowNone, key=key,
+                                             **kwargs)
+        self._refClass = refClass
+
+    def set(self, value):
+        if isinstance(value, self._refClass):
+            return value
+        if isinstance(value, dict):
+            obj = self._refClass()
+            obj.setValues(value)
+            return obj
+        return None if self.allowNone else self._refClass()
 
     def __set__(self, instance, value):
-        if self.value:
-            self.value.setValues(value)
+        if not self._name:
+            return
+        data = instance._prop_data
+        value = self.set(value)
+        if value is not None:
+            value._parent = instance
+        if instance.loaded and data.get(self._name) is not value:
+            instance._prop_dirty.add(self._name)
+        data[self._name] = value
+
+    def __get__(self, instance, owner):
+        data = instance._prop_data
+        if self._name not in data:
+            _checkLoaded(instance, self._name)
+            self.__set__(instance, None)
+            instance._prop_dirty.discard(self._name)
+        return data[self._name]
+
+
+class MongoIndex(object):
+    ''' An index declared in the `indexes` of a model class. `keys` is an
+    attribute name, or a list of attribute names and (attribute, direction)
+    pairs, where direction is 1, -1, '2d', '2dsphere' or 'text'. `options`
+    are passed on to create_index, like `unique`, `sparse` or, for a TTL
+    index, `expireAfterSeconds` '''
+
+    def __init__(self, keys, **options):
+        if isinstance(keys, basestring):
+            keys = [keys]
+        self.keys = tuple((i, 1) if isinstance(i, basestring) else tuple(i)
+                          for i in keys)
+        self.options = options
+
+
+def _keysetSort(sort):
+    ''' `sort` as a list of (key, 1 or -1) ending with `_id` '''
+    sort = list(txmongo.filter.sort(sort)['orderby'])
+    if any(d not in (1, -1) for _, d in sort):
+        raise ValueError('Pages can only be sorted ascending or descending')
+    if '_id' not in [k for k, _ in sort]:
+        sort.append(('_id', sort[-1][1] if sort else 1))
+    return sort
+
+
+def _docValue(doc, key):
+    for i in key.split('.'):
+        doc = doc.get(i) if isinstance(doc, dict) else None
+    return doc
+
+
+def _encodeToken(sort, doc):
+    ''' A page token for the position of `doc` in `sort` order '''
+    token = {'k': [list(i) for i in sort],
+             'v': [_docValue(doc, k) for k, _ in sort]}
+    return base64.urlsafe_b64encode(BSON.encode(token))
+
+
+def _decodeToken(token, sort):
+    ''' The sort key values of a page token '''
+    try:
+        token = BSON(base64.urlsafe_b64decode(str(token))).decode()
+    except (TypeError, ValueError, BSONError):
+        raise ValueError('Invalid page token')
+    if [tuple(i) for i in token.get('k', [])] != [tuple(i) for i in sort]:
+        raise ValueError('The page token is for another sort order')
+    return token['v']
+
+
+def _keysetQuery(search, order, values):
+    ''' `search` limited to the rows after `values` in `order` '''
+    clauses = []
+    for n, (key, direction) in enumerate(order):
+        clause = dict((k, v) for (k, _), v in zip(order[:n], values[:n]))
+        value = values[n]
+        # Nulls sort first, and compare only with other nulls
+        if value is None:
+            if direction == -1:
+                continue
+            clause[key] = {'$ne': None}
+        elif direction == 1:
+            clause[key] = {'$gt': value}
+        else:
+            nulls = dict(clause)
+            nulls[key] = None
+            clauses.append(nulls)
+            clause[key] = {'$lt': value}
+        clauses.append(clause)
+    after = {'$or': clauses} if clauses else {'_id': {'$exists': False}}
+    return {'$and': [search, after]} if search else after
+
+
+def _indexKey(schema, attr):
+    ''' The document key of a dotted attribute path '''
+    head, sep, rest = attr.partition('.')
+    return schema.attrToKey.get(head, head) + sep + rest
+
+
+def _indexOptions(info):
+    ''' The options of an index, from its declaration or index_information,
+    that make two indexes on the same keys different '''
+    out = {}
+    for k in ('unique', 'sparse'):
+        if info.get(k):
+            out[k] = True
+    if info.get('expireAfterSeconds') is not None:
+        out['expireAfterSeconds'] = int(info['expireAfterSeconds'])
+    return out
+
+
+def _planStages(plan):
+    ''' The stages of an explained query plan '''
+    stages = [plan.get('stage')]
+    if 'inputStage' in plan:
+        stages.extend(_planStages(plan['inputStage']))
+    for i in plan.get('inputStages', []):
+        stages.extend(_planStages(i))
+    return stages
+
+
+def _pipelineExpr(schema, expr):
+    ''' An aggregation expression with its `$attribute` field paths
+    changed to document keys '''
+    if isinstance(expr, basestring):
+        if expr.startswith('$') and not expr.startswith('$$'):
+            return '$' + _indexKey(schema, expr[1:])
+        return expr
+    if isinstance(expr, dict):
+        out = expr.__class__()
+        for k, v in expr.iteritems():
+            out[k] = v if k == '$literal' else _pipelineExpr(schema, v)
+        return out
+    if isinstance(expr, (list, tuple)):
+        return [_pipelineExpr(schema, i) for i in expr]
+    return expr
+
+
+def _pipelineMatch(schema, search):
+    ''' A query with its attribute names changed to document keys '''
+    out = search.__class__()
+    for k, v in search.iteritems():
+        if k in ('$and', '$or', '$nor'):
+            out[k] = [_pipelineMatch(schema, i) for i in v]
+        elif k == '$expr':
+            out[k] = _pipelineExpr(schema, v)
+        elif k.startswith('$'):
+            out[k] = v
+        else:
+            out[_indexKey(schema, k)] = v
+    return out
 
 
 class MongoObj(MongoSubObj):
@@ -495,12 +1630,40 @@ class MongoObj(MongoSubObj):
     __metaclass__ = metaMongoObj
     mongo = None
     display_timezone = None
+    # Keep instance values in a list and dirty flags in a bitmask instead
+    # of a dict and a set per instance. Subclasses of a compact class are
+    # compact too
+    compact = False
+    # A MongoCache to serve findOne and load from
+    cache = None
+    # Share one query between concurrent identical findOne, load and find
+    # calls
+    coalesce = False
+    # A MongoCache to serve the documents of find queries from
+    query_cache = None
+    # The pymongo WriteConcern of saves and removes: WriteConcern(w=0) to
+    # not wait for writes, WriteConcern(j=True) to wait for the journal or
+    # WriteConcern(w='majority', wtimeout=5000). None waits for
+    # acknowledgement
+    write_concern = None
+    # A MongoWriteBuffer to queue the updates of save in
+    write_buffer = None
+    # MongoIndex declarations, in addition to the indexes of properties
+    indexes = ()
+    # Explain find and count queries first, and warn with a
+    # CollectionScanWarning when they scan the whole collection. Meant for
+    # development, it doubles the queries
+    explain_queries = False
 
     def __init__(self):
+        if self.compact:
+            self._values = [_missing] * len(self._slotKeys)
+            self._dirty_mask = 0
+            for k, v in self._slotDefaults:
+                setattr(self, k, v)
+        else:
+            super(MongoObj, self).__init__()
         self._id = None
-        self._prop_data = {}
-        self._prop_dirty = set()
-        super(MongoObj, self).__init__()
 
     @classmethod
     def connect(cls, host, port, username=None, password=None, database=None, authdatabase=None):
@@ -512,7 +1675,7 @@ class MongoObj(MongoSubObj):
             cls.dbname = database
 
         def _after_connect(res):
-            cls.mongo = res
+            cls.mongo = TxMongoBackend(res)
         details = {
             "host": host,
             "port": port,
@@ -529,6 +1692,12 @@ class MongoObj(MongoSubObj):
         d.addCallback(_after_connect)
         return d
 
+    @classmethod
+    def setBackend(cls, backend):
+        ''' Get collections from `backend` instead of a server connection '''
+        assert isinstance(backend, Backend)
+        cls.mongo = backend
+
     @classmethod
     def disconnect(cls):
         if cls.mongo is None:
@@ -556,37 +1725,147 @@ class MongoObj(MongoSubObj):
 
     @classmethod
     def getCollection(cls):
+        if isinstance(cls.mongo, Backend):
+            return cls.mongo.getCollection(cls.dbname, cls.collection)
+        # A txmongo connection set on the class directly
         db = getattr(cls.mongo, cls.dbname)
         collection = getattr(db, cls.collection)
         return collection
 
+    @classmethod
+    def _declaredIndexes(cls):
+        ''' An OrderedDict of {keys: options} for the indexes declared by
+        every class stored in this collection '''
+        classes = [cls] + [i for i in metaMongoObj.registry.values()
+                           if i.collection == cls.collection and
+                           i.dbname == cls.dbname and i is not cls]
+        out = OrderedDict()
+        for model in classes:
+            schema = model._schema()
+            declared = []
+            for field in schema.fields:
+                prop = field.prop
+                if prop.index:
+                    direction = prop.index
+                    if direction is True:
+                        direction = prop._indexType
+                    options = dict((k, True) for k in ('unique', 'sparse')
+                                   if getattr(prop, k))
+                    declared.append((((field.key, direction), ), options))
+            for index in model.indexes:
+                keys = tuple((_indexKey(schema, k), d) for k, d in index.keys)
+                declared.append((keys, index.options))
+            for keys, options in declared:
+                if keys in out and \
+                        _indexOptions(out[keys]) != _indexOptions(options):
+                    raise ValueError('%s declares the index %r with different '
+                                     'options' % (model.__name__, keys))
+                out.setdefault(keys, options)
+        return out
+
+    @classmethod
+    @defer.inlineCallbacks
+    def ensure_indexes(cls, drop=False):
+        ''' Create the declared indexes of this collection that do not
+        exist. An existing index on the same keys with other options is
+        reported as conflicting, and indexes nobody declared as undeclared;
+        with `drop` both are dropped, and the conflicting ones recreated.
+        Fires with a dict of index names under 'created', 'dropped',
+        'conflicting' and 'undeclared' '''
+        collection = cls.getCollection()
+        existing = yield collection.index_information()
+        byKeys = {}
+        for name, info in existing.iteritems():
+            keys = tuple((k, int(v) if isinstance(v, float) else v)
+                         for k, v in info['key'].items())
+            byKeys[keys] = (name, info)
+        report = {'created': [], 'dropped': [], 'conflicting': [],
+                  'undeclared': []}
+        for keys, options in cls._declaredIndexes().iteritems():
+            found = byKeys.pop(keys, None)
+            if found is not None:
+                if _indexOptions(found[1]) == _indexOptions(options):
+                    continue
+                if not drop:
+                    report['conflicting'].append(found[0])
+                    continue
+                yield collection.drop_index(found[0])
+                report['dropped'].append(found[0])
+            name = yield collection.create_index(
+                txmongo.filter.sort(list(keys)), **options)
+            report['created'].append(name)
+        for name, info in byKeys.itervalues():
+            if name == '_id_':
+                continue
+            if drop:
+                yield collection.drop_index(name)
+                report['dropped'].append(name)
+            else:
+                report['undeclared'].append(name)
+        defer.returnValue(report)
+
+    @classmethod
+    def _checkPlan(cls, command, search):
+        ''' Explain `command` and warn if it scans the whole collection '''
+        collection = cls.getCollection()
+        if isinstance(collection, Collection):
+            d = collection.database.command(SON([
+                ('explain', command), ('verbosity', 'queryPlanner')]))
+        else:
+            d = collection.explain(command)
+
+        def _after(res):
+            if 'COLLSCAN' in _planStages(res['queryPlanner']['winningPlan']):
+                warnings.warn('%s query %r scans the whole %s collection' % (
+                    cls.__name__, _queryShape(search), cls.collection),
+                    CollectionScanWarning)
+        d.addCallback(_after)
+        d.addErrback(log.err, 'Could not explain a query of %s' % cls.__name__)
+        return d
+
     @classmethod
     @defer.inlineCallbacks
-    def findOne(cls, docid, loadRefs=False):
+    def findOne(cls, docid, loadRefs=False, session=None, fields=None):
         if docid is not None and not isinstance(docid, ObjectId):
             # Raises exception if docid is not ObjectId-able
             docid = ObjectId(docid)
         if docid is None:
             defer.returnValue(cls())
-        collection = cls.getCollection()
-        doc = yield collection.find_one({'_id': docid})
+        if session is not None:
+            existing = session.get(cls, docid)
+            if existing is not None:
+                if loadRefs:
+                    yield existing.loadRefs()
+                defer.returnValue(existing)
+        projection, loadedFields = cls._projection(fields)
+        op = _begin(cls, 'findOne', {'_id': docid})
+        doc = yield op.wait(cls._findCached(docid, projection))
         if not doc:
+            op.finish()
             err = '{} with the id {} not found'.format(cls.__name__, docid)
             raise KeyError(err)
 
-        if "_unmarshal_class" in doc:
-            newcls = cls._find_class(doc["_unmarshal_class"])
-        else:
-            newcls = cls
-        new_object = newcls()
-        new_object.setValues(doc)
+        try:
+            if "_unmarshal_class" in doc:
+                newcls = cls._find_class(doc["_unmarshal_class"])
+            else:
+                newcls = cls
+            new_object = newcls()
+            new_object._loaded_fields = loadedFields
+            new_object.setValues(doc)
+        except Exception:
+            op.finish(failure=Failure())
+            raise
         new_object.loaded = True
+        op.finish([doc])
+        if session is not None:
+            new_object = session.add(new_object)
         if loadRefs:
             yield new_object.loadRefs()
         defer.returnValue(new_object)
 
     @defer.inlineCallbacks
-    def load(self, docid=None):
+    def load(self, docid=None, fields=None):
         # mongo = yield txmongo.MongoConnectionPool('127.0.0.1', 27017)
 
         if docid is not None and not isinstance(docid, ObjectId):
@@ -595,23 +1874,161 @@ class MongoObj(MongoSubObj):
         if docid is None:
             defer.returnValue(self)
 
-        collection = self.getCollection()
-
-        docs = yield collection.find({'_id': docid}, limit=1)
-        if not len(docs):
+        projection, loadedFields = self._projection(fields)
+        op = _begin(self.__class__, 'load', {'_id': docid})
+        doc = yield op.wait(self._findCached(docid, projection))
+        if not doc:
+            op.finish()
             raise KeyError('Object id: %s not found' % docid)
 
-        self.setValues(docs[0])
+        self._loaded_fields = loadedFields
+        try:
+            self.setValues(doc)
+        except Exception:
+            op.finish(failure=Failure())
+            raise
+        op.finish([doc])
 
         self.loaded = True
+        if self._session is not None:
+            self._session.add(self)
 
         defer.returnValue(self)
 
+    @defer.inlineCallbacks
+    def loadFields(self, *fields):
+        ''' Fetch fields that a partial load left out. With no arguments
+        every missing field is fetched '''
+        if self._loaded_fields is None or self._id is None:
+            defer.returnValue(self)
+        projection, loadedFields = self._projection(fields or None)
+        doc = yield self.getCollection().find_one({'_id': self._id},
+                                                  fields=projection)
+        if not doc:
+            raise KeyError('Object id: %s not found' % self._id)
+
+        missing = dict((k, v) for k, v in doc.iteritems()
+                       if k not in self._loaded_fields and
+                       k not in self._prop_data)
+        self.setValues(missing)
+        self._prop_dirty.difference_update(missing)
+        if loadedFields is None:
+            self._loaded_fields = None
+        else:
+            self._loaded_fields = self._loaded_fields | loadedFields
+        defer.returnValue(self)
+
+    @classmethod
+    @defer.inlineCallbacks
+    def _findCached(cls, docid, projection):
+        ''' Fetch the document with the id `docid`, through the class cache
+        if it has one. Partial loads always go to the server '''
+        cache = cls.cache if projection is None else None
+        key = (cls.collection, docid)
+        if cache is not None:
+            doc = cache.get(key)
+            if doc is not None:
+                defer.returnValue(doc)
+        writes = _writes.get(cls.collection, 0)
+
+        def fetch():
+            d = cls.getCollection().find_one({'_id': docid}, fields=projection)
+            if cache is not None:
+                d.addCallback(_store)
+            return d
+
+        def _store(doc):
+            # Anything written while the query ran may not be in doc
+            if doc and _writes.get(cls.collection, 0) == writes:
+                cache.set(key, doc)
+            return doc
+
+        if cls.coalesce:
+            doc = yield _coalesce(('findOne', cls.collection, writes, docid,
+                                   _queryKey(projection)), fetch)
+        else:
+            doc = yield fetch()
+        defer.returnValue(doc)
+
+    @classmethod
+    def _written(cls, *docids):
+        ''' Note a write to this class's collection. Later reads no longer
+        join queries already in flight, cached query results for the
+        collection are dropped, and so are the documents with `docids` '''
+        _writes[cls.collection] = _writes.get(cls.collection, 0) + 1
+        if cls.query_cache is not None:
+            cls.query_cache.clear(cls.collection)
+        if cls.cache is not None:
+            for i in docids:
+                cls.cache.invalidate((cls.collection, i))
+
+    @classmethod
+    def _projection(cls, fields):
+        ''' Translate the attribute names in `fields` into a projection.
+        Returns the projection and the set of keys it loads '''
+        if fields is None:
+            return None, None
+        attrToKey = cls._schema().attrToKey
+        keys = set(attrToKey.get(i, i) for i in fields)
+        keys.update(('_id', '_unmarshal_class'))
+        return dict((i, 1) for i in keys), frozenset(keys)
+
     @classmethod
     def find(cls, search, **kwargs):
         ''' Get a list of all objects in this collection that match _search_'''
         return MongoSet(search, cls, **kwargs)._runQuery()
 
+    @classmethod
+    @defer.inlineCallbacks
+    def page(cls, search, sort, limit=20, after=None, before=None, **kwargs):
+        ''' A page of at most `limit` objects matching _search_ in `sort`
+        order, a list of (key, direction) pairs. Pages are found by range
+        queries on the sort keys, with `_id` to break ties, instead of
+        skipping rows.
+
+        Fires with a MongoSet whose `next_page` and `previous_page` are
+        tokens for the neighbouring pages, or None where there are none.
+        Pass them back with the same search and sort as `after` and
+        `before` '''
+        if after is not None and before is not None:
+            raise ValueError('Pass at most one of after and before')
+        sort = _keysetSort(sort)
+        backward = before is not None
+        order = [(k, -d) for k, d in sort] if backward else sort
+        token = before if backward else after
+        query = search
+        if token is not None:
+            query = _keysetQuery(search, order, _decodeToken(token, sort))
+        if kwargs.get('fields') is not None:
+            kwargs['fields'] = list(kwargs['fields']) + [k for k, _ in sort]
+        res = yield cls.find(query, sort=order, limit=limit + 1, **kwargs)
+        more = len(res._docs) > limit
+        res._docs = res._docs[:limit]
+        res._result = res._result[:limit]
+        if backward:
+            res._docs.reverse()
+            res._result.reverse()
+        if res._docs:
+            if backward or more:
+                res.next_page = _encodeToken(sort, res._docs[-1])
+            if more if backward else after is not None:
+                res.previous_page = _encodeToken(sort, res._docs[0])
+        defer.returnValue(res)
+
+    @classmethod
+    def iter_find(cls, search, batch_size=100, **kwargs):
+        ''' Stream the objects that match _search_ in batches of
+        `batch_size`. Returns a `MongoStream` '''
+        return MongoStream(search, cls, batch_size=batch_size, **kwargs)
+
+    @classmethod
+    def export(cls, search, target, format='ndjson', **kwargs):
+        ''' Stream the objects that match _search_ to `target` as NDJSON or
+        CSV. See `txmongoobject.export.MongoExporter` '''
+        from txmongoobject.export import MongoExporter
+        return MongoExporter(cls, search, target, format=format,
+                             **kwargs).start()
+
     @classmethod
     def find_and_modify(cls, query=None, update=None, sort=None, **kwargs):
         ''' Get a single document from `query` and modify it with `update` '''
@@ -632,7 +2049,9 @@ class MongoObj(MongoSubObj):
 
         def _after(res):
             if res is None:
+                cls._written()
                 return res
+            cls._written(res.get('_id'))
             new_object = cls()
             new_object.setValues(res)
             new_object.loaded = True
@@ -644,56 +2063,202 @@ class MongoObj(MongoSubObj):
     @classmethod
     def count(cls, search):
         collection = cls.getCollection()
-        d = collection.count(search)
+        if cls.explain_queries:
+            command = SON([('count', cls.collection), ('query', search)])
+            d = cls._checkPlan(command, search)
+            d.addCallback(lambda _: cls._count(collection, search))
+            return d
+        return cls._count(collection, search)
+
+    @classmethod
+    def _count(cls, collection, search):
+        op = _begin(cls, 'count', search)
+        d = op.wait(collection.count(search))
 
         def _afterCount(res):
+            op.finish()
             # count returns a float by default. Cast to int.
             return int(res)
         d.addCallback(_afterCount)
         return d
 
+    @classmethod
+    def _writeOptions(cls, write_concern=None):
+        ''' The txmongo keyword arguments for `write_concern`, or the class
+        write concern '''
+        if write_concern is None:
+            write_concern = cls.write_concern
+        if write_concern is None:
+            return {'safe': True}
+        return dict(write_concern.document, safe=write_concern.acknowledged)
+
     @defer.inlineCallbacks
-    def save(self):
+    def save(self, write_concern=None):
+        ''' Insert the object, or update its changed fields. An
+        unacknowledged `write_concern` fires as soon as the write is sent.
+        With a `write_buffer` and no `write_concern`, updates are queued in
+        the buffer and written later '''
         collection = self.getCollection()
+        options = self._writeOptions(write_concern)
 
         data = self.getValues()
         if '_id' in data and data['_id'] is None:
             del data['_id']
 
         if '_id' not in data:
-            olddata = data.copy()
-            data = self.create(data)
-            newkeys = filter(lambda k: data[k] != olddata[k], data.keys())
-            for i in newkeys:
-                setattr(self, i, data[i])
-            data['cdate'] = datetime.today()
-            self.cdate = data['cdate']
+            data = self._createValues(data)
+            self._clearChanges()
         else:
-            data_out = {}
-            for i in self._prop_dirty:
-                if i not in data or i == '_id':
-                    continue
-                data_out[i] = data[i]
-            if not data_out:
-                self._prop_dirty.clear()
+            data = self._updateOps(data)
+            self._clearChanges()
+            if not data:
+                defer.returnValue(None)
+            if self.write_buffer is not None and write_concern is None:
+                self.write_buffer.add(self.__class__, self._id, data)
                 defer.returnValue(None)
 
-            data = {'$set': data_out}
-            self._prop_dirty.clear()
-            out = yield collection.update({'_id': self._id}, data, safe=True)
+            op = _begin(self.__class__, 'save', {'_id': self._id})
+            out = yield op.wait(collection.update({'_id': self._id}, data,
+                                                  **options))
+            self._written(self._id)
+            op.finish()
             defer.returnValue(out)
 
-        result = yield collection.save(data, safe=True)
+        op = _begin(self.__class__, 'save')
+        result = yield op.wait(collection.save(data, **options))
+        self._written()
+        op.finish()
         if result.__class__ is ObjectId:
             self._id = result
             self.loaded = True
+            if self._session is not None:
+                self._session.add(self)
 
         defer.returnValue(result)
 
+    def _createValues(self, data):
+        ''' Run `create` and set `cdate` for a new object. Returns the
+        document to insert '''
+        olddata = data.copy()
+        data = self.create(data)
+        newkeys = filter(lambda k: data[k] != olddata[k], data.keys())
+        for i in newkeys:
+            setattr(self, i, data[i])
+        data['cdate'] = datetime.today()
+        self.cdate = data['cdate']
+        return data
+
+    def _updateOps(self, data):
+        ''' The update document for the changes made since the object was
+        loaded, given `data` from getValues. Empty when nothing changed '''
+        ops = {'$set': {}, '$unset': {}, '$push': {}, '$pull': {}}
+        self._collectChanges(ops, data=data)
+        ops['$set'].pop('_id', None)
+        return dict((k, v) for k, v in ops.iteritems() if v)
+
+    @classmethod
     @defer.inlineCallbacks
-    def insert_unique(self, query):
+    def save_many(cls, objs, ordered=False, batch_size=1000,
+                  write_concern=None):
+        ''' Save `objs` with bulk writes. New objects are inserted and
+        modified objects get an update of their changes, `batch_size`
+        documents per write. Fires with a dict of {index in objs: error}
+        for the objects that could not be saved.
+
+        With `ordered` the objects are written in the order given and the
+        first failure stops the save. The objects after it are left unsaved
+        and get a `skipped` error. `write_concern` overrides the write
+        concern of the objects' classes '''
+        writes = []
+        for index, obj in enumerate(objs):
+            data = obj.getValues()
+            if data.get('_id') is None:
+                data.pop('_id', None)
+                data = obj._createValues(data)
+                data['_id'] = ObjectId()
+                writes.append(('insert', obj.collection, (index, obj, data)))
+                continue
+            update = obj._updateOps(data)
+            if not update:
+                obj._clearChanges()
+                continue
+            op = UpdateOne({'_id': obj._id}, update)
+            writes.append(('update', obj.collection, (index, obj, op)))
+
+        # Ordered saves write runs of the same kind and collection in turn,
+        # unordered ones one group per kind and collection
+        runs = []
+        if ordered:
+            for kind, name, item in writes:
+                if runs and runs[-1][:2] == (kind, name):
+                    runs[-1][2].append(item)
+                else:
+                    runs.append((kind, name, [item]))
+        else:
+            groups = OrderedDict()
+            for kind, name, item in writes:
+                groups.setdefault((kind, name), []).append(item)
+            runs = [key + (batch, ) for key, batch in groups.iteritems()]
+
+        errors = {}
+
+        def _write(batch, write):
+            d = defer.maybeDeferred(write, [i[2] for i in batch])
+
+            def _failed(failure):
+                if failure.check(BulkWriteError):
+                    failed = failure.value.details.get('writeErrors', [])
+                    for i in failed:
+                        index = batch[i['index']][0]
+                        errors[index] = dict(i, index=index)
+                    if not ordered:
+                        return set(i['index'] for i in failed)
+                    first = min(i['index'] for i in failed) if failed else 0
+                    return set(range(first, len(batch)))
+                for i in batch:
+                    errors[i[0]] = failure.value
+                return set(range(len(batch)))
+            d.addCallbacks(lambda _: set(), _failed)
+            return d
+
+        for kind, name, batch in runs:
+            collection = batch[0][1].getCollection()
+            concern = write_concern or batch[0][1].write_concern
+            if concern is not None:
+                collection = collection.with_options(write_concern=concern)
+            if kind == 'insert':
+                write = collection.insert_many
+            else:
+                write = collection.bulk_write
+            write = functools.partial(write, ordered=ordered)
+            for chunk in chunks(batch, batch_size):
+                failed = yield _write(chunk, write)
+                for k, (index, obj, data) in enumerate(chunk):
+                    if k in failed:
+                        continue
+                    if kind == 'insert':
+                        obj._id = data['_id']
+                        obj.loaded = True
+                        if obj._session is not None:
+                            obj._session.add(obj)
+                    obj._clearChanges()
+                chunk[0][1]._written(*[i[1]._id for i in chunk])
+                if ordered and errors:
+                    first = min(errors)
+                    for _, _, (index, obj, data) in writes:
+                        if index > first and index not in errors:
+                            errors[index] = {'index': index, 'skipped': True,
+                                             'errmsg': 'not saved after an '
+                                                       'earlier error'}
+                    defer.returnValue(errors)
+
+        defer.returnValue(errors)
+
+    @defer.inlineCallbacks
+    def insert_unique(self, query, write_concern=None):
         ''' Atomically insert a document. Raises `DocumentExists` if `query`
-        matches any documents
+        matches any documents. The write is always acknowledged, since the
+        result is needed
         '''
         assert isinstance(query, dict)
         collection = self.getCollection()
@@ -701,23 +2266,35 @@ class MongoObj(MongoSubObj):
         data = self.getValues()
         if "_id" in data:
             del data["_id"]
-        self._prop_dirty.clear()
+        self._clearChanges()
         insert = {"$setOnInsert": data}
-        out = yield collection.update(query, insert, upsert=True, safe=True)
+        options = self._writeOptions(write_concern)
+        if not options['safe']:
+            options = {'safe': True}
+        out = yield collection.update(query, insert, upsert=True, **options)
+        self._written()
         if "upserted" not in out or not out["upserted"]:
             raise DocumentExists("Document already exits.")
         self._id = out["upserted"]
         self.loaded = True
+        if self._session is not None:
+            self._session.add(self)
         defer.returnValue(out["upserted"])
 
     @defer.inlineCallbacks
-    def remove(self):
+    def remove(self, write_concern=None):
         ''' Delete a single object '''
         if not self.loaded:
             defer.returnValue(False)
 
         collection = self.getCollection()
-        res = yield collection.remove({'_id': self._id})
+        if self.write_buffer is not None:
+            self.write_buffer.discard(self.__class__, self._id)
+        options = self._writeOptions(write_concern)
+        res = yield collection.remove({'_id': self._id}, **options)
+        self._written(self._id)
+        if self._session is not None:
+            self._session.discard(self)
         self._prop_data.clear()
         self._prop_dirty.clear()
         self._id = None
@@ -725,23 +2302,52 @@ class MongoObj(MongoSubObj):
         defer.returnValue(res)
 
     @classmethod
-    def aggregate(cls, spec, **kwargs):
+    def aggregate(cls, spec, hydrate=False, **kwargs):
+        ''' Run the aggregation pipeline `spec`, a list of stages or a
+        `MongoPipeline`. Fires with the output documents, or with `hydrate`
+        with a MongoSet that turns them into objects of this class, or of
+        the class named by their `_unmarshal_class` '''
+        if isinstance(spec, MongoPipeline):
+            spec = spec.stages
         collection = cls.getCollection()
+        op = _begin(cls, 'aggregate', spec)
+        d = op.wait(collection.aggregate(spec, **kwargs))
 
-        return collection.aggregate(spec, **kwargs)
+        def _after(res):
+            op.finish(res if isinstance(res, list) else ())
+            if hydrate:
+                return MongoSet(None, cls)._setDocs(res)
+            return res
+        return d.addCallback(_after)
+
+    @classmethod
+    def iter_aggregate(cls, spec, batch_size=100, allow_disk_use=False,
+                       hydrate=False):
+        ''' Stream the output of the aggregation pipeline `spec` from a
+        server cursor in batches of `batch_size`. Returns a
+        `MongoAggregateStream` '''
+        if isinstance(spec, MongoPipeline):
+            spec = spec.stages
+        return MongoAggregateStream(spec, cls, batch_size=batch_size,
+                                    allow_disk_use=allow_disk_use,
+                                    hydrate=hydrate)
+
+    @classmethod
+    def pipeline(cls):
+        ''' A `MongoPipeline` for this class '''
+        return MongoPipeline(cls)
 
     @classmethod
     def _find_class(cls, name):
         ''' Find a class to unmarshal by name '''
-        classes = _all_subclasses(MongoObj)
-        out = filter(lambda k: k.__name__ == name, classes)
-        if not out:
-            # Shrug and give up?
-            return cls
-        return out[0]
+        # Shrug and give up if there is none
+        return metaMongoObj.registry.get((cls.collection, name), cls)
 
 
 class MongoSet(object):
+    ''' The results of a query. Documents are kept as they come back from
+    the server, and each one is turned into an object the first time it is
+    accessed. With `raw` the documents themselves are returned '''
 
     _limit = 0
     _skip = 0
@@ -749,21 +2355,32 @@ class MongoSet(object):
     _data = None
     _queryRun = False
     _result = None
+    _docs = None
+    # Page tokens set by MongoObj.page
+    next_page = None
+    previous_page = None
     _display_timezone = None
     _use_cursor = False
+    _raw = False
 
     def __init__(self, search, cls, limit=0, skip=0, sort=None,
-                 loadRefs=False, display_timezone=None, use_cursor=False):
+                 loadRefs=False, display_timezone=None, use_cursor=False,
+                 session=None, fields=None, raw=False, ref_concurrency=None):
         self._search = search
         self._class = cls
         self._limit = limit
         self._skip = skip
         self._sort = sort
         self._loadRefs = loadRefs
+        self._refConcurrency = ref_concurrency
         self._display_timezone = display_timezone
         self._result = []
+        self._docs = []
+        self._raw = raw
         self._use_cursor = use_cursor
         self._cursor = None
+        self._session = session
+        self._projection, self._loadedFields = cls._projection(fields)
 
     def limit(self, num):
         self._limit = num
@@ -775,12 +2392,16 @@ class MongoSet(object):
         self._sort = obj
 
     def __iter__(self):
-        for i in self._result:
-            # yield self._applyItem(i)
-            yield i
+        for i in xrange(len(self._docs)):
+            yield self[i]
 
     def __len__(self):
-        return len(self._result)
+        return len(self._docs)
+
+    def _setDocs(self, docs):
+        self._docs = docs
+        self._result = [None] * len(docs)
+        return self
 
     def _afterQuery(self, objs):
         self._result = objs
@@ -794,8 +2415,16 @@ class MongoSet(object):
 
     @defer.inlineCallbacks
     def _runQuery(self):
+        if self._class.explain_queries and not self._cursor:
+            command = SON([('find', self._class.collection),
+                           ('filter', self._search)])
+            if self._sort is not None:
+                orderby = txmongo.filter.sort(self._sort)['orderby']
+                command['sort'] = SON(orderby)
+            yield self._class._checkPlan(command, self._search)
+        op = _begin(self._class, 'find', self._search)
         if self._cursor:
-            docs, self._cursor = yield self._cursor
+            docs, self._cursor = yield op.wait(self._cursor)
         else:
             collection = self._class.getCollection()
             if self._sort is not None:
@@ -803,78 +2432,759 @@ class MongoSet(object):
             else:
                 ftr = None
             if self._use_cursor:
-                docs, self._cursor = yield collection.find(spec=self._search,
-                                                           limit=self._limit,
-                                                           skip=self._skip,
-                                                           filter=ftr,
-                                                           cursor=self._use_cursor)
+                d = collection.find(spec=self._search, fields=self._projection,
+                                    limit=self._limit, skip=self._skip,
+                                    filter=ftr, cursor=self._use_cursor)
+                docs, self._cursor = yield op.wait(d)
             else:
-                docs = yield collection.find(spec=self._search,
-                                             limit=self._limit,
-                                             skip=self._skip,
-                                             filter=ftr,
-                                             cursor=self._use_cursor)
+                docs = yield op.wait(self._find(collection, ftr))
 
-        out = []
-        for i in docs:
-            o = self._applyItem(i)
-            if self._loadRefs:
-                yield o.loadRefs()
-            out.append(o)
-        # print "SENDING"
-        # defer.returnValue(out)
-        self._result = out
+        self._docs = docs
+        self._result = [None] * len(docs)
+        if self._loadRefs and not self._raw:
+            try:
+                yield loadAllRefs(list(self), session=self._session,
+                                  concurrency=self._refConcurrency)
+            except Exception:
+                op.finish(failure=Failure())
+                raise
+        op.finish(docs)
         defer.returnValue(self)
 
-        # load refs (if there are any)
-        # if self._loadRefs:
-        #     for i in docs:
-        #         yield i.loadRefs()
-        #     schema = self._class().schema
-        #     for k, v in schema.iteritems():
-        #         if not isinstance(v, referenceProperty):
-        #             continue
-        #         ids = set()
-        #         for i in docs:
-        #             val = i.get(k, None)
-        #             if val is None:
-        #                 continue
-        #             ids.add(val)
-        #         if not len(ids):
-        #             continue
-        #         for j in chunks(list(ids), 100):
-        #             tmp = yield v._refCls.find({'_id': {'$in': j}})
-        #             _tmp = {}
-        #             for i in tmp:
-        #                 _tmp[i._id] = i
-        #             del tmp
-        #             for i in docs:
-        #                 key = i.get(k, None)
-        #                 if key in _tmp:
-        #                     i[k] = _tmp[key]
-        #                 else:
-        #                     i[k] = None
-
-        # self._result = docs
-        # defer.returnValue(self)
+    def _find(self, collection, ftr):
+        ''' Run the query, through the class query cache and coalescing if
+        the class has them turned on '''
+        cls = self._class
+        cache = cls.query_cache
+        writes = _writes.get(cls.collection, 0)
+        key = None
+        if cache is not None or cls.coalesce:
+            key = (cls.collection, _queryKey([self._search, self._sort,
+                                              self._skip, self._limit,
+                                              self._projection]))
+        if cache is not None:
+            cached = cache.get(key)
+            if cached is not None:
+                return defer.succeed(cached['docs'])
+
+        def fetch():
+            d = collection.find(spec=self._search, fields=self._projection,
+                                limit=self._limit, skip=self._skip, filter=ftr)
+            if cache is not None:
+                d.addCallback(_store)
+            return d
+
+        def _store(docs):
+            # Anything written while the query ran may not be in docs
+            if _writes.get(cls.collection, 0) == writes:
+                cache.set(key, {'docs': docs})
+            return docs
+
+        if cls.coalesce:
+            return _coalesce(('find', writes) + key, fetch)
+        return fetch()
+
+    def to_columns(self, fields):
+        ''' Build a NumPy array for each attribute in `fields` straight from
+        the documents, without hydrating objects. Requires NumPy; see
+        `txmongoobject.columns.toColumns` for the column types '''
+        from txmongoobject.columns import toColumns
+        return toColumns(self._class, self._docs, fields)
 
     def __getitem__(self, index):
         if index.__class__ is not int:
             raise TypeError
-        return self._result[index]
+        if self._raw:
+            return self._docs[index]
+        obj = self._result[index]
+        if obj is None:
+            obj = self._result[index] = self._applyItem(self._docs[index])
+        return obj
 
     def _applyItem(self, obj):
+        if self._session is not None:
+            existing = self._session.get(self._class, obj.get('_id'))
+            if existing is not None:
+                return existing
         if "_unmarshal_class" in obj and obj["_unmarshal_class"] != self._class.__name__:
             cls = self._class._find_class(obj["_unmarshal_class"])
         else:
             cls = self._class
         out = cls()
         out.display_timezone = self._display_timezone
+        out._loaded_fields = self._loadedFields
         out.setValues(obj)
         out.loaded = True
+        if self._session is not None:
+            self._session.add(out)
         return out
 
 
+class MongoStream(object):
+    ''' Reads the results of a query in batches, walking the collection in
+    `_id` order. Each batch is its own query, sent only when the consumer
+    asks for it, so memory is bounded by one batch however many documents
+    match, and stopping early leaves no cursor open on the server.
+
+    `skip` only applies to the first batch. The order is always `_id`, so
+    `sort` and `use_cursor` raise ValueError '''
+
+    def __init__(self, search, cls, batch_size=100, limit=0, skip=0, **kwargs):
+        if batch_size <= 0:
+            raise ValueError('batch_size must be positive')
+        for i in ('sort', 'use_cursor'):
+            if kwargs.get(i):
+                raise ValueError('%s is not supported, streams are read in '
+                                 '_id order' % i)
+        kwargs.pop('sort', None)
+        kwargs.pop('use_cursor', None)
+        self._search = search
+        self._class = cls
+        self._batch_size = batch_size
+        self._limit = limit
+        self._skip = skip
+        self._kwargs = kwargs
+        self._last = None
+        self._done = False
+        self._lock = defer.DeferredLock()
+        self.fetched = 0
+
+    def next(self):
+        ''' Returns a Deferred that fires with the next list of objects, or
+        with an empty list once the results are exhausted '''
+        d = self._lock.run(self._fetch)
+        d.addCallback(lambda res: list(res) if res is not None else [])
+        return d
+
+    def next_columns(self, fields):
+        ''' Returns a Deferred that fires with the next batch as NumPy
+        columns (see `MongoSet.to_columns`), or with an empty dict once the
+        results are exhausted '''
+        d = self._lock.run(self._fetch)
+        d.addCallback(lambda res: res.to_columns(fields)
+                      if res is not None else {})
+        return d
+
+    @defer.inlineCallbacks
+    def _fetch(self):
+        ''' Run the query for the next batch. Fires with its MongoSet, or
+        None once the results are exhausted '''
+        size = self._batch_size
+        if self._limit:
+            size = min(size, self._limit - self.fetched)
+        if self._done or size <= 0:
+            self._done = True
+            defer.returnValue(None)
+
+        spec = self._search
+        if self._last is not None:
+            after = {'_id': {'$gt': self._last}}
+            spec = {'$and': [spec, after]} if spec else after
+        skip = self._skip if self._last is None else 0
+        res = yield MongoSet(spec, self._class, limit=size, skip=skip,
+                             sort=[('_id', 1)], **self._kwargs)._runQuery()
+        docs = res._docs
+        if len(docs) < size:
+            self._done = True
+        if not docs:
+            defer.returnValue(None)
+        self._last = docs[-1]['_id']
+        self.fetched += len(docs)
+        defer.returnValue(res)
+
+    @defer.inlineCallbacks
+    def each(self, func):
+        ''' Call `func` with every object. When `func` returns a Deferred the
+        next object waits for it to fire, and returning False stops the
+        stream. Fires with the number of objects processed '''
+        count = 0
+        while True:
+            batch = yield self.next()
+            if not batch:
+                break
+            for obj in batch:
+                res = yield defer.maybeDeferred(func, obj)
+                count += 1
+                if res is False:
+                    self.close()
+                    defer.returnValue(count)
+        defer.returnValue(count)
+
+    def close(self):
+        ''' Stop reading. Later calls to `next()` fire with an empty list '''
+        self._done = True
+
+
+class MongoAggregateStream(MongoStream):
+    ''' Reads the output of an aggregation pipeline in batches from a
+    server cursor, so memory is bounded by one batch however much the
+    pipeline returns. `allow_disk_use` lets the server spill large sorts
+    and groups to disk. Closing the stream early kills the cursor.
+
+    Backends without server cursors run the whole pipeline at once and
+    hand out the output in batches '''
+
+    def __init__(self, pipeline, cls, batch_size=100, allow_disk_use=False,
+                 hydrate=False):
+        if batch_size <= 0:
+            raise ValueError('batch_size must be positive')
+        self._pipeline = pipeline
+        self._class = cls
+        self._batch_size = batch_size
+        self._allowDiskUse = allow_disk_use
+        self._hydrate = hydrate
+        self._cursorId = None
+        self._buffered = None
+        self._done = False
+        self._lock = defer.DeferredLock()
+        self.fetched = 0
+
+    @defer.inlineCallbacks
+    def _fetch(self):
+        ''' Read the next batch from the cursor. Fires with its MongoSet, or
+        None once the output is exhausted '''
+        if self._done:
+            defer.returnValue(None)
+        collection = self._class.getCollection()
+        op = _begin(self._class, 'aggregate', self._pipeline)
+        if isinstance(collection, Collection):
+            docs = yield op.wait(self._command(collection))
+        else:
+            if self._buffered is None:
+                options = {'allowDiskUse': True} if self._allowDiskUse else {}
+                self._buffered = yield op.wait(
+                    collection.aggregate(self._pipeline, **options))
+            docs = self._buffered[:self._batch_size]
+            self._buffered = self._buffered[self._batch_size:]
+            if not self._buffered:
+                self._done = True
+        op.finish(docs)
+        if not docs:
+            self._done = True
+            defer.returnValue(None)
+        self.fetched += len(docs)
+        res = MongoSet(None, self._class, raw=not self._hydrate)
+        defer.returnValue(res._setDocs(docs))
+
+    def _command(self, collection):
+        ''' Open the cursor, or read its next batch. Fires with the
+        documents '''
+        database = collection.database
+        if self._cursorId is None:
+            options = {'allowDiskUse': True} if self._allowDiskUse else {}
+            d = database.command('aggregate', collection.name,
+                                 pipeline=self._pipeline,
+                                 cursor={'batchSize': self._batch_size},
+                                 **options)
+        else:
+            d = database.command('getMore', self._cursorId,
+                                 collection=collection.name,
+                                 batchSize=self._batch_size)
+
+        def _after(res):
+            cursor = res['cursor']
+            self._cursorId = cursor['id']
+            if not self._cursorId:
+                self._done = True
+            return cursor.get('firstBatch', cursor.get('nextBatch', []))
+        return d.addCallback(_after)
+
+    def close(self):
+        ''' Stop reading and kill the server cursor if it is still open.
+        Later calls to `next()` fire with an empty list '''
+        self._done = True
+        self._buffered = None
+        if self._cursorId:
+            collection = self._class.getCollection()
+            cursorId, self._cursorId = self._cursorId, None
+            d = collection.database.command('killCursors', collection.name,
+                                            cursors=[cursorId])
+            d.addErrback(log.err, 'Could not kill an aggregation cursor of '
+                         '%s' % self._class.__name__)
+
+
+class MongoPipeline(object):
+    ''' Builds an aggregation pipeline for a model class. The stage
+    methods take attribute names, and field paths such as `'$views'` in
+    expressions, and change them to document keys through the `key=` of
+    the properties. Each returns the pipeline, so calls can be chained:
+
+        Article.pipeline().match({'published': True}).group(
+            '$author', views={'$sum': '$views'}).aggregate()
+
+    Output fields named after attributes get their document keys too, so a
+    pipeline whose output matches the model can be hydrated '''
+
+    def __init__(self, cls):
+        self._class = cls
+        self.stages = []
+
+    def _add(self, stage):
+        self.stages.append(stage)
+        return self
+
+    def match(self, search):
+        schema = self._class._schema()
+        return self._add({'$match': _pipelineMatch(schema, search)})
+
+    def project(self, *fields, **expressions):
+        ''' Keep `fields`, and add the computed `expressions` '''
+        schema = self._class._schema()
+        spec = SON((_indexKey(schema, i), 1) for i in fields)
+        for k, v in expressions.iteritems():
+            if v not in (0, 1, True, False):
+                v = _pipelineExpr(schema, v)
+            spec[_indexKey(schema, k)] = v
+        return self._add({'$project': spec})
+
+    def group(self, by, **accumulators):
+        ''' Group on the expression `by`, with one output field per
+        accumulator, such as `total={'$sum': '$views'}` '''
+        schema = self._class._schema()
+        spec = SON([('_id', _pipelineExpr(schema, by))])
+        for k, v in accumulators.iteritems():
+            spec[_indexKey(schema, k)] = _pipelineExpr(schema, v)
+        return self._add({'$group': spec})
+
+    def lookup(self, other, localField, foreignField, as_):
+        ''' Join the documents of the model class `other`, or of the
+        collection named `other`, whose `foreignField` equals `localField`,
+        as a list in `as_` '''
+        schema = self._class._schema()
+        if isinstance(other, basestring):
+            collection = other
+        else:
+            collection = other.collection
+            foreignField = _indexKey(other._schema(), foreignField)
+        return self._add({'$lookup': SON([
+            ('from', collection),
+            ('localField', _indexKey(schema, localField)),
+            ('foreignField', foreignField),
+            ('as', _indexKey(schema, as_))])})
+
+    def sort(self, sort):
+        ''' Sort on a list of (attribute, direction) pairs '''
+        schema = self._class._schema()
+        return self._add({'$sort': SON((_indexKey(schema, k), d)
+                                       for k, d in sort)})
+
+    def limit(self, num):
+        return self._add({'$limit': num})
+
+    def stage(self, stage):
+        ''' Add a stage as it is, without changing any names '''
+        return self._add(stage)
+
+    def aggregate(self, hydrate=False, **kwargs):
+        return self._class.aggregate(self.stages, hydrate=hydrate, **kwargs)
+
+    def iter_aggregate(self, **kwargs):
+        return self._class.iter_aggregate(self.stages, **kwargs)
+
+
+class MongoCache(object):
+    ''' A read-through cache of documents. Set an instance as the `cache`
+    of a model class to serve `findOne` and `load` from it, or as the
+    `query_cache` to serve the results of `find`. Once there are `size`
+    entries the least recently used is evicted, and entries expire `ttl`
+    seconds after they were fetched.
+
+    Documents are kept BSON encoded, and every hit decodes a fresh copy, so
+    changing a loaded object never changes the cache. Writes through the
+    model class drop the entries they touch, writes from elsewhere are only
+    seen once the entry expires. `hits` and `misses` count lookups '''
+
+    def __init__(self, size=1000, ttl=None, clock=time.time):
+        if size <= 0:
+            raise ValueError('size must be positive')
+        self.size = size
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        ''' A copy of the document stored under `key`, or None '''
+        entry = self._entries.pop(key, None)
+        if entry is not None and \
+                (entry[0] is None or entry[0] > self._clock()):
+            self._entries[key] = entry
+            self.hits += 1
+            return BSON(entry[1]).decode()
+        self.misses += 1
+        return None
+
+    def set(self, key, doc):
+        expires = None if self.ttl is None else self._clock() + self.ttl
+        self._entries.pop(key, None)
+        self._entries[key] = (expires, BSON.encode(doc))
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self, collection=None):
+        ''' Drop every entry, or only those for `collection` '''
+        if collection is None:
+            self._entries.clear()
+            return
+        for key in [i for i in self._entries if i[0] == collection]:
+            del self._entries[key]
+
+
+def _overlaps(path, other):
+    ''' True if one of two dotted paths is the other or inside it '''
+    if len(path) > len(other):
+        path, other = other, path
+    return other == path or other.startswith(path + '.')
+
+
+def _mergeUpdate(pending, update):
+    ''' One update document doing `pending` and then `update`, or None when
+    they change the same paths in ways one update cannot express '''
+    out = dict((k, dict(v)) for k, v in pending.iteritems())
+    for op, fields in update.iteritems():
+        for path, value in fields.iteritems():
+            related = [(o, p) for o, paths in out.iteritems() for p in paths
+                       if _overlaps(p, path)]
+            if op in ('$set', '$unset'):
+                # Replaces whatever was done at or inside the path
+                if any(len(p) < len(path) for o, p in related):
+                    return None
+                for o, p in related:
+                    del out[o][p]
+                out.setdefault(op, {})[path] = value
+            elif op == '$push':
+                if not related:
+                    out.setdefault(op, {})[path] = value
+                elif related == [('$push', path)]:
+                    out[op][path] = {
+                        '$each': out[op][path]['$each'] + value['$each']}
+                elif related == [('$set', path)] and \
+                        isinstance(out['$set'][path], list):
+                    out['$set'][path] = out['$set'][path] + value['$each']
+                else:
+                    return None
+            elif op == '$pull':
+                if not related:
+                    out.setdefault(op, {})[path] = value
+                elif related == [('$pull', path)]:
+                    values = [i['$in'] if isinstance(i, dict) else [i]
+                              for i in (out[op][path], value)]
+                    out[op][path] = {'$in': values[0] + values[1]}
+                else:
+                    return None
+            else:
+                return None
+    return dict((k, v) for k, v in out.iteritems() if v)
+
+
+class MongoWriteBuffer(object):
+    ''' Write-behind for the updates of saved objects. Set an instance as
+    the `write_buffer` of model classes, and `save` of a loaded object
+    queues its changes here instead of writing them. Repeated updates of
+    one document are merged, and the queue is written with unordered bulk
+    writes once it holds `size` documents, `interval` seconds after an
+    update was queued, on `flush`, and before the reactor shuts down.
+
+    Inserts, and saves given a write concern, are still written at once,
+    and reads only see queued changes once they are written. Every bulk
+    write is reported to the observers as a 'flush' of the model class,
+    with the updates as its documents. `peak` is the most documents ever
+    queued, and `failures` counts the updates that could not be written '''
+
+    def __init__(self, size=1000, interval=1.0, reactor=None):
+        if size <= 0:
+            raise ValueError('size must be positive')
+        if reactor is None:
+            from twisted.internet import reactor
+        self.size = size
+        self.interval = interval
+        self.peak = 0
+        self.failures = 0
+        self._reactor = reactor
+        self._queued = OrderedDict()
+        self._count = 0
+        self._call = None
+        self._lock = defer.DeferredLock()
+        self._trigger = reactor.addSystemEventTrigger('before', 'shutdown',
+                                                      self.flush)
+
+    def __len__(self):
+        ''' The number of documents with queued updates '''
+        return self._count
+
+    def add(self, cls, docid, update):
+        ''' Queue `update` of the document `docid` of `cls` '''
+        key = (cls.dbname, cls.collection)
+        queued = self._queued.get(key)
+        if queued is None:
+            queued = self._queued[key] = (cls, OrderedDict())
+        updates = queued[1].get(docid)
+        if updates is None:
+            queued[1][docid] = [update]
+            self._count += 1
+            self.peak = max(self.peak, self._count)
+        else:
+            merged = _mergeUpdate(updates[-1], update)
+            if merged is None:
+                # Written after the queued update, in a later bulk write
+                updates.append(update)
+            else:
+                updates[-1] = merged
+        if self._count >= self.size:
+            self.flush()
+        elif self._call is None:
+            self._call = self._reactor.callLater(self.interval, self._timeout)
+
+    def discard(self, cls, docid):
+        ''' Drop the queued updates of the document `docid` of `cls` '''
+        queued = self._queued.get((cls.dbname, cls.collection))
+        if queued is not None and queued[1].pop(docid, None) is not None:
+            self._count -= 1
+
+    def _timeout(self):
+        self._call = None
+        self.flush()
+
+    def flush(self):
+        ''' Write everything queued. Fires with the number of updates that
+        failed, once this and every earlier flush is written '''
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+        queued = self._queued.values()
+        self._queued = OrderedDict()
+        self._count = 0
+        return self._lock.run(self._write, queued)
+
+    def close(self):
+        ''' Flush, and stop flushing on reactor shutdown '''
+        self._reactor.removeSystemEventTrigger(self._trigger)
+        return self.flush()
+
+    @defer.inlineCallbacks
+    def _write(self, queued):
+        failed = 0
+        for cls, updates in queued:
+            if not updates:
+                continue
+            collection = cls.getCollection()
+            if cls.write_concern is not None:
+                collection = collection.with_options(
+                    write_concern=cls.write_concern)
+            # Updates that could not be merged go in later writes, so that
+            # each document gets its updates in order
+            for n in xrange(max(len(i) for i in updates.itervalues())):
+                ids = [k for k, v in updates.iteritems() if len(v) > n]
+                for chunk in chunks(ids, self.size):
+                    docs = [updates[i][n] for i in chunk]
+                    requests = [UpdateOne({'_id': i}, doc)
+                                for i, doc in zip(chunk, docs)]
+                    op = _begin(cls, 'flush')
+                    error = 'Error writing buffered updates to %s' % \
+                        cls.collection
+                    try:
+                        yield op.wait(collection.bulk_write(requests,
+                                                            ordered=False))
+                    except BulkWriteError as e:
+                        failed += len(e.details.get('writeErrors', [])) or \
+                            len(chunk)
+                        log.err(None, error)
+                    except Exception:
+                        failed += len(chunk)
+                        log.err(None, error)
+                    else:
+                        op.finish(docs)
+                    cls._written(*chunk)
+        self.failures += failed
+        defer.returnValue(failed)
+
+
+class MongoSession(object):
+    ''' An identity map of model objects. Objects loaded through a session
+    are hydrated once per (collection, _id), and every later load through
+    the session returns that same instance '''
+
+    def __init__(self):
+        self._identity = {}
+        self._new = []
+
+    def __len__(self):
+        return len(self._identity) + len(self._new)
+
+    def __iter__(self):
+        return iter(self._identity.values() + self._new)
+
+    def get(self, cls, docid):
+        ''' The tracked instance of `cls` with the id `docid`, or None '''
+        return self._identity.get((cls.collection, docid))
+
+    def add(self, obj):
+        ''' Track `obj`. Returns the instance already tracked for its _id if
+        there is one, otherwise `obj` '''
+        self._new = [i for i in self._new if i is not obj]
+        if obj._id is None:
+            obj._session = self
+            self._new.append(obj)
+            return obj
+        key = (obj.collection, obj._id)
+        existing = self._identity.get(key)
+        if existing is not None:
+            return existing
+        obj._session = self
+        self._identity[key] = obj
+        return obj
+
+    def discard(self, obj):
+        ''' Stop tracking `obj` '''
+        self._new = [i for i in self._new if i is not obj]
+        if self._identity.get((obj.collection, obj._id)) is obj:
+            del self._identity[(obj.collection, obj._id)]
+        obj._session = None
+
+    def clear(self):
+        for i in self:
+            i._session = None
+        self._identity.clear()
+        self._new = []
+
+    def findOne(self, cls, docid, loadRefs=False):
+        return cls.findOne(docid, loadRefs=loadRefs, session=self)
+
+    def find(self, cls, search, **kwargs):
+        kwargs['session'] = self
+        return cls.find(search, **kwargs)
+
+    def dirty(self):
+        ''' All tracked objects that are new or have unsaved changes '''
+        return [i for i in self if i._id is None or i._hasChanges()]
+
+    def flush(self):
+        ''' Save every new or modified object in this session '''
+        saves = [i.save() for i in self.dirty()]
+        return defer.gatherResults(saves, consumeErrors=True)
+
+
+@defer.inlineCallbacks
+def loadAllRefs(objs, chunkSize=100, session=None, concurrency=None):
+    ''' Load the references of every object in `objs`. Ids are collected
+    across all of the objects and fetched with one `$in` query per
+    referenced class per `chunkSize` ids. A missing reference is set to
+    None, a missing member of a reference list raises `KeyError`.
+
+    The queries run one after another, or with `concurrency` up to that
+    many at once. References already tracked by `session` are not fetched
+    again '''
+    op = _begin(objs[0].__class__, 'loadRefs') if objs else _noOperation
+    docs = []
+    wanted = {}
+    for obj in objs:
+        schema = obj._schema()
+        for field in schema.refLists:
+            if not obj._isLoaded(field.key):
+                continue
+            refCls = field.prop._defaultWrapper._refCls
+            for i in getattr(obj, field.attr) or []:
+                if i is None or isinstance(i, refCls):
+                    continue
+                wanted.setdefault(refCls, set()).add(i)
+        for field in schema.references:
+            if not obj._isLoaded(field.key):
+                continue
+            refCls = field.prop._refCls
+            val = getattr(obj, field.attr)
+            if val is None or isinstance(val, refCls):
+                continue
+            wanted.setdefault(refCls, set()).add(val)
+
+    found = {}
+    lookups = []
+    for refCls, ids in wanted.iteritems():
+        loaded = found[refCls] = {}
+        if session is not None:
+            for i in list(ids):
+                existing = session.get(refCls, i)
+                if existing is not None:
+                    loaded[i] = existing
+                    ids.discard(i)
+        for chunk in chunks(list(ids), chunkSize):
+            lookups.append((refCls, chunk))
+
+    def lookup(refCls, chunk):
+        return refCls.find({'_id': {'$in': chunk}}, session=session)
+
+    if concurrency and len(lookups) > 1:
+        semaphore = defer.DeferredSemaphore(concurrency)
+        d = defer.gatherResults([semaphore.run(lookup, *i) for i in lookups],
+                                consumeErrors=True)
+        d.addErrback(lambda failure: failure.value.subFailure)
+        results = yield op.wait(d)
+    else:
+        results = []
+        for i in lookups:
+            res = yield op.wait(lookup(*i))
+            results.append(res)
+
+    for (refCls, chunk), res in zip(lookups, results):
+        docs.extend(res._docs)
+        for i in res:
+            found[refCls][i._id] = i
+
+    for obj in objs:
+        schema = obj._schema()
+        for field in schema.refLists:
+            if not obj._isLoaded(field.key):
+                continue
+            refCls = field.prop._defaultWrapper._refCls
+            val = getattr(obj, field.attr)
+            if val is None:
+                val = []
+            tmp = []
+            for i in val:
+                if i is None or isinstance(i, refCls):
+                    tmp.append(i)
+                    continue
+                if i not in found[refCls]:
+                    err = KeyError('Object id: %s not found' % i)
+                    op.finish(docs, failure=Failure(err))
+                    raise err
+                tmp.append(found[refCls][i])
+            if val.__class__ is _trackedList:
+                # The same references, loaded: not a change to save
+                list.__setitem__(val, slice(None), tmp)
+            else:
+                setattr(obj, field.attr, tmp)
+        for field in schema.references:
+            if not obj._isLoaded(field.key):
+                continue
+            refCls = field.prop._refCls
+            val = getattr(obj, field.attr)
+            if val is None or isinstance(val, refCls):
+                continue
+            setattr(obj, field.attr, found[refCls].get(val))
+    op.finish(docs)
+
+
+@defer.inlineCallbacks
+def ensure_all_indexes(drop=False):
+    ''' Run `ensure_indexes` for every collection that model classes
+    declare indexes for. Fires with a dict of {collection: report} '''
+    models = {}
+    for cls in metaMongoObj.registry.values():
+        if cls.indexes or any(i.prop.index for i in cls._schema().fields):
+            models.setdefault((cls.dbname, cls.collection), cls)
+    out = {}
+    for (dbname, collection), cls in sorted(models.items()):
+        out[collection] = yield cls.ensure_indexes(drop=drop)
+    defer.returnValue(out)
+
+
 def chunks(l, n):
     """ Yield successive n-sized chunks from l.
     From StackOverflow: http://stackoverflow.com/a/312464/999844
@@ -0,0 +1,111 @@
+''' Latency statistics for model operations.
+
+`LatencyStats` is an observer for `model.addObserver` that keeps a
+histogram of operation latencies per model class and operation, to be
+dumped on demand. '''
+import math
+
+
+class Histogram(object):
+    ''' Counts of integer values in log-linear buckets, in the style of
+    HdrHistogram. Every bucket is narrower than `digits` significant decimal
+    digits of the values it holds, so percentiles keep that precision however
+    wide the range of values is, in memory that grows with the logarithm of
+    the range '''
+
+    def __init__(self, digits=2):
+        self._subBits = int(math.ceil(math.log(2 * 10 ** digits, 2)))
+        self._counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        value = max(0, int(value))
+        shift = max(0, value.bit_length() - self._subBits)
+        bucket = value >> shift << shift
+        self._counts[bucket] = self._counts.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        ''' The value that `percent` of the recorded values are at or below,
+        to the precision of the histogram. None when it is empty '''
+        if not self.count:
+            return None
+        rank = max(1, int(math.ceil(percent / 100.0 * self.count)))
+        seen = 0
+        for bucket in sorted(self._counts):
+            seen += self._counts[bucket]
+            if seen >= rank:
+                shift = max(0, bucket.bit_length() - self._subBits)
+                return min(bucket + (1 << shift) - 1, self.max)
+        return self.max
+
+    def mean(self):
+        if not self.count:
+            return None
+        return float(self.total) / self.count
+
+
+class LatencyStats(object):
+    ''' Keeps a histogram of operation durations, in microseconds, per model
+    class and operation. Register it with `model.addObserver(stats)` '''
+
+    percentiles = (50, 90, 99, 99.9)
+
+    def __init__(self, digits=2):
+        self._digits = digits
+        self._ops = {}
+
+    def __call__(self, event):
+        if event['event'] != 'finish':
+            return
+        key = (event['class'].__name__, event['operation'])
+        op = self._ops.get(key)
+        if op is None:
+            op = self._ops[key] = {'histogram': Histogram(self._digits),
+                                   'network': 0.0, 'python': 0.0,
+                                   'documents': 0, 'bytes': 0, 'failures': 0}
+        op['histogram'].record(event['duration'] * 1e6)
+        op['network'] += event['network']
+        op['python'] += event['python']
+        op['documents'] += event['documents']
+        op['bytes'] += event['bytes']
+        if event['failure'] is not None:
+            op['failures'] += 1
+
+    def histogram(self, cls, operation):
+        ''' The Histogram for `operation` on the model class `cls`, or None '''
+        op = self._ops.get((cls.__name__, operation))
+        return op['histogram'] if op is not None else None
+
+    def dump(self):
+        ''' A dict of {class name: {operation: statistics}}. Latencies are
+        in microseconds, the network and python totals in seconds '''
+        out = {}
+        for (name, operation), op in self._ops.iteritems():
+            hist = op['histogram']
+            stats = {
+                'count': hist.count,
+                'min': hist.min,
+                'max': hist.max,
+                'mean': hist.mean(),
+                'network': op['network'],
+                'python': op['python'],
+                'documents': op['documents'],
+                'bytes': op['bytes'],
+                'failures': op['failures'],
+            }
+            for i in self.percentiles:
+                stats['p%s' % ('%g' % i).replace('.', '')] = hist.percentile(i)
+            out.setdefault(name, {})[operation] = stats
+        return out
+
+    def reset(self):
+        self._ops.clear()